@@ -1,15 +1,100 @@
 import os
-from flask import Flask, jsonify, request, abort
+from flask import Flask, request, abort
 from flask_cors import CORS
-from models import setup_db, Strategy, Bot
+from models import setup_db, db, Strategy, Bot, row_hooks
 import json, requests
 from auth import requires_auth, AuthError
+from serializers import jsonify
+from pagination import Page
+from delta import Delta
+from bulk import read_bulk_rows, validate_rows, validate_strategy, validate_bot
+from filters import bot_filters, param_filters
+from fields import STRATEGY_FIELDS, STRATEGY_DETAIL_FIELDS, BOT_FIELDS, BOT_DETAIL_FIELDS
+from streaming import wants_stream, stream_ndjson
+from etags import versioned
+from changes import change_listener
+from response_cache import cached_listing, response_cache
+from pool import pool_status
+from metrics import init_metrics
+from querycount import query_budget
+from transfer import stream_copy, copy_in
+from feed import stream_changes
+from coalesce import ActiveWrites, WRITE_COALESCING, COALESCE_TIMEOUT
+from replica import replica_router, REPLICA_BIND
+
+# Writes of a subject, on this worker or on the others, send its reads to
+# the primary for a while
+change_listener.subscribe_rows(replica_router.wrote)
+row_hooks.append(replica_router.wrote)
+replica_router.shared_events = lambda: not change_listener.local_only
 
 def create_app(test_config=None):
 
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     setup_db(app)
     CORS(app)
+    init_metrics(app)
+    # Opt-in group commits for the active toggles of PATCH /bots/<id>
+    active_writes = ActiveWrites(app) if app.config.get('WRITE_COALESCING', WRITE_COALESCING) else None
+
+    @app.before_request
+    def start_change_listener():
+        # One listener thread per worker process, started after the fork
+        change_listener.start(app)
+
+    '''
+    Bulk responses
+    Per-row results shared by the bulk create routes
+    '''
+
+    def bulk_success(ids):
+        return jsonify({
+            'success' : True,
+            'count' : len(ids),
+            'results' : [
+                {'index' : index, 'success' : True, 'id' : record_id}
+                for index, record_id in enumerate(ids)
+            ]
+        }), 200
+
+    def bulk_error(results):
+        return jsonify({
+            'success' : False,
+            'error' : 400,
+            'message' : 'bad request',
+            'results' : results
+        }), 400
+
+    '''
+    Strategy and bot values
+    Column values supplied in a PATCH body, only the fields present
+    '''
+
+    def strategy_values(body):
+        values = {}
+        if body.get('name') is not None:
+            values['name'] = body.get('name')
+
+        if body.get('params') is not None:
+            values['params'] = body.get('params').split(', ')
+
+        return values
+
+    def bot_values(body):
+        values = {}
+        for field in ('name', 'active', 'strategy_id', 'timeframe'):
+            if body.get(field) is not None:
+                values[field] = body.get(field)
+
+        if body.get('param_values') is not None:
+            values['param_values'] = body.get('param_values').split(', ')
+
+        return values
+
+    def is_toggle(values):
+        return list(values) == ['active'] and isinstance(values['active'], bool)
 
     '''
     Strategies Routes
@@ -23,37 +108,59 @@ def create_app(test_config=None):
         }
         return jsonify(response), 200
 
+    @app.route('/cache-stats')
+    @requires_auth('get:stats')
+    def get_cache_stats(payload):
+        response = response_cache.stats()
+        response['notifications'] = change_listener.notifications
+        return jsonify(response), 200
+
+    @app.route('/pool-stats')
+    @requires_auth('get:stats')
+    def get_pool_stats(payload):
+        response = {'primary': pool_status(db.engine)}
+        if REPLICA_BIND in (app.config.get('SQLALCHEMY_BINDS') or {}):
+            response[REPLICA_BIND] = pool_status(db.get_engine(app, bind=REPLICA_BIND))
+        return jsonify(response), 200
+
     @app.route('/strategies')
+    @query_budget(3)
+    @cached_listing('strategy')
+    @versioned('strategy')
     def get_strategies():
-        strategies = Strategy.query.all()
-        response = []
-        for strategy in strategies:
-            record = {
-                'id' : strategy.id,
-                'name' : strategy.name,
-            }
-            response.append(record)
-        return jsonify(response), 200
+        query, record = STRATEGY_FIELDS.select()
+        delta = Delta.from_request()
+        if delta.enabled:
+            strategies = delta.fetch(query, Strategy)
+            return delta.response([record(strategy) for strategy in strategies], Strategy), 200
+
+        page = Page.from_request()
+        strategies = page.fetch(query, Strategy.id)
+        response = [record(strategy) for strategy in strategies]
+        return page.response(response), 200
 
     @app.route('/strategies-detail')
+    @query_budget(3)
     @requires_auth('get:strategies')
+    @versioned('strategy')
     def get_strategies_detail(payload):
-        strategies = Strategy.query.all()
-        response = []
-        for strategy in strategies:
-            record = {
-                'id' : strategy.id,
-                'name' : strategy.name,
-                'params' : [par for par in strategy.params],
-            }
-            response.append(record)
-        return jsonify(response), 200
+        query, record = STRATEGY_DETAIL_FIELDS.select()
+        delta = Delta.from_request()
+        if delta.enabled:
+            strategies = delta.fetch(query, Strategy)
+            return delta.response([record(strategy) for strategy in strategies], Strategy), 200
+        if wants_stream():
+            return stream_ndjson(query, Strategy.id, record)
+
+        page = Page.from_request()
+        strategies = page.fetch(query, Strategy.id)
+        response = [record(strategy) for strategy in strategies]
+        return page.response(response), 200
     
     @app.route('/strategies/create', methods = ['POST'])
     @requires_auth('post:strategies')
     def post_strategy(payload):
         body = request.get_json()
-        count = Strategy.query.count()
 
         try:
             record = Strategy(
@@ -75,33 +182,66 @@ def create_app(test_config=None):
         except Exception:
             abort(400)
 
+    @app.route('/strategies/bulk', methods = ['POST'])
+    @requires_auth('post:strategies')
+    def post_strategies_bulk(payload):
+        rows = read_bulk_rows()
+        values, results = validate_rows(rows, validate_strategy)
+        if values is None:
+            return bulk_error(results)
+
+        try:
+            ids = Strategy.bulk_insert(values)
+        except Exception:
+            db.session.rollback()
+            abort(400)
+
+        return bulk_success(ids)
+
+    @app.route('/strategies/export')
+    @requires_auth('get:strategies')
+    def export_strategies(payload):
+        return stream_copy(Strategy)
+
+    @app.route('/strategies/import', methods = ['POST'])
+    @query_budget(8)
+    @requires_auth('post:strategies', 'patch:strategies')
+    def import_strategies(payload):
+        # An upsert, it creates rows and overwrites existing ones
+        try:
+            count = copy_in(Strategy, request.stream)
+        except Exception:
+            db.session.rollback()
+            abort(400)
+
+        return jsonify({'success' : True, 'count' : count}), 200
+
     @app.route('/strategies/<int:strategy_id>', methods = ['PATCH'])
+    @query_budget(8)
     @requires_auth('patch:strategies')
     def edit_strategy(payload, strategy_id):
         body = request.get_json()
-        strategy = Strategy.query.filter(Strategy.id == strategy_id).one_or_none()
-        
-        try:
-            if body.get('name') is not None:
-                strategy.name = body.get('name')
-            
-            if body.get('params') is not None:
-                strategy.params = body.get('params').split(', ')
 
-            strategy.update()
+        try:
+            values = strategy_values(body)
+            strategy = Strategy.update_by_id(strategy_id, values)
+        except Exception:
+            db.session.rollback()
+            abort(400)
 
-            response = {
-                'success' : True,
-                'name' : strategy.name,
-                'params' : strategy.params
-            }
+        if strategy is None:
+            abort(404)
 
-            return jsonify(response), 200
+        response = {
+            'success' : True,
+            'name' : strategy.name,
+            'params' : strategy.params
+        }
 
-        except Exception:
-            abort(400)
+        return jsonify(response), 200
 
     @app.route('/strategies/<int:strategy_id>', methods = ['DELETE'])
+    @query_budget(8)
     @requires_auth('delete:strategies')
     def delete_strategy(payload, strategy_id):
         strategy = Strategy.query.filter(Strategy.id == strategy_id).one_or_none()
@@ -126,45 +266,76 @@ def create_app(test_config=None):
     '''
 
     @app.route('/bots')
+    @query_budget(3)
+    @cached_listing('bot')
+    @versioned('bot')
     def get_bots():
-        bots = Bot.query.all()
-        response = []
-        for bot in bots:
-            record = {
-                'id' : bot.id,
-                'name' : bot.name,
-                'active' : bot.active,
-            }
-            response.append(record)
-
-        return jsonify(response), 200
+        query, record = BOT_FIELDS.select()
+        query = query.filter(*bot_filters())
+        delta = Delta.from_request()
+        if delta.enabled:
+            bots = delta.fetch(query, Bot)
+            return delta.response([record(bot) for bot in bots], Bot), 200
+
+        page = Page.from_request()
+        bots = page.fetch(query, Bot.id)
+        response = [record(bot) for bot in bots]
+        return page.response(response), 200
 
     @app.route('/bots-detail')
-    @requires_auth('get:bots')    
+    @query_budget(3)
+    @requires_auth('get:bots')
+    @versioned('bot', 'strategy')
     def get_bots_details(payload):
-        bots = Bot.query.all()
-        response = []
-        for bot in bots:
-            strategy = Strategy.query.filter(Strategy.id == bot.strategy_id).one_or_none()
-            record = {
-                'id' : bot.id,
-                'name' : bot.name,
-                'active' : bot.active,
-                'strategy' : strategy.name,
-                'strategy_id' : bot.strategy_id,
-                'timeframe' : bot.timeframe,
-                'params' : [ par for par in strategy.params ],
-                'param_values' : [ val for val in bot.param_values ],
-            }
-            response.append(record)
-
-        return jsonify(response), 200
+        # Strategy is joined, one query for the whole listing
+        query, record = BOT_DETAIL_FIELDS.select()
+        query = query.filter(*bot_filters())
+        delta = Delta.from_request()
+        if delta.enabled:
+            # A bot also changes with the name or params of its strategy
+            bots = delta.fetch(query, Bot, Bot.strategy)
+            return delta.response([record(bot) for bot in bots], Bot), 200
+        if wants_stream():
+            return stream_ndjson(query, Bot.id, record)
+
+        page = Page.from_request()
+        bots = page.fetch(query, Bot.id)
+        response = [record(bot) for bot in bots]
+        return page.response(response), 200
     
+    @app.route('/bots/changes')
+    @requires_auth('get:bots')
+    def get_bot_changes(payload):
+        # Behind PgBouncer without DATABASE_LISTEN_URL the stream would only
+        # carry the commits of this worker
+        if change_listener.local_only:
+            abort(503)
+        last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+        return stream_changes(last_id, payload.get('exp'))
+
+    @app.route('/bots/search')
+    @query_budget(2)
+    @requires_auth('get:bots')
+    @versioned('bot', 'strategy')
+    def search_bots(payload):
+        clauses = param_filters()
+        if not clauses:
+            abort(400)
+
+        query, record = BOT_DETAIL_FIELDS.select()
+        query = query.filter(*bot_filters()).filter(*clauses)
+        if wants_stream():
+            return stream_ndjson(query, Bot.id, record)
+
+        page = Page.from_request()
+        bots = page.fetch(query, Bot.id)
+        response = [record(bot) for bot in bots]
+        return page.response(response), 200
+
     @app.route('/bots/create', methods = ['POST'])
     @requires_auth('post:bots')
     def post_bot(payload):
         body = request.get_json()
-        count = Bot.query.count()
 
         try:
             record = Bot(
@@ -192,46 +363,152 @@ def create_app(test_config=None):
         except Exception:
             abort(400)
     
+    @app.route('/bots/bulk', methods = ['POST'])
+    @requires_auth('post:bots')
+    def post_bots_bulk(payload):
+        rows = read_bulk_rows()
+        referenced = {
+            row.get('strategy_id') for row in rows
+            if isinstance(row, dict) and isinstance(row.get('strategy_id'), int)
+        }
+        strategy_ids = {
+            strategy_id for (strategy_id,) in
+            db.session.query(Strategy.id).filter(Strategy.id.in_(referenced))
+        } if referenced else set()
+
+        values, results = validate_rows(rows, lambda row: validate_bot(row, strategy_ids))
+        if values is None:
+            return bulk_error(results)
+
+        try:
+            ids = Bot.bulk_insert(values)
+        except Exception:
+            db.session.rollback()
+            abort(400)
+
+        return bulk_success(ids)
+
+    @app.route('/bots/export')
+    @requires_auth('get:bots')
+    def export_bots(payload):
+        return stream_copy(Bot)
+
+    @app.route('/bots/import', methods = ['POST'])
+    @query_budget(8)
+    @requires_auth('post:bots', 'patch:bots')
+    def import_bots(payload):
+        # An upsert, it creates rows and overwrites existing ones
+        try:
+            count = copy_in(Bot, request.stream)
+        except Exception:
+            db.session.rollback()
+            abort(400)
+
+        return jsonify({'success' : True, 'count' : count}), 200
+
+    @app.route('/bots', methods = ['PATCH'])
+    @query_budget(8)
+    @requires_auth('patch:bots')
+    def edit_bots(payload):
+        clauses = bot_filters()
+        body = request.get_json(silent=True)
+
+        try:
+            values = bot_values(body)
+        except Exception:
+            abort(400)
+
+        # Refuse to touch the whole fleet without an explicit filter
+        if not clauses or not values:
+            abort(400)
+
+        try:
+            ids = Bot.update_where(clauses, values)
+        except Exception:
+            db.session.rollback()
+            abort(400)
+
+        response = {
+            'success' : True,
+            'count' : len(ids),
+            'ids' : ids
+        }
+
+        return jsonify(response), 200
+
+    @app.route('/bots', methods = ['DELETE'])
+    @query_budget(8)
+    @requires_auth('delete:bots')
+    def delete_bots(payload):
+        clauses = bot_filters()
+        if not clauses:
+            abort(400)
+
+        try:
+            ids = Bot.delete_where(clauses)
+        except Exception:
+            db.session.rollback()
+            abort(400)
+
+        response = {
+            'success' : True,
+            'count' : len(ids),
+            'ids' : ids
+        }
+
+        return jsonify(response), 200
+
     @app.route('/bots/<int:bot_id>', methods = ['PATCH'])
+    @query_budget(8)
     @requires_auth('patch:bots')
     def edit_bot(payload, bot_id):
         body = request.get_json()
-        bot = Bot.query.filter(Bot.id == bot_id).one_or_none()
 
         try:
-            if body.get('name') is not None:
-                bot.name = body.get('name')
-        
-            if body.get('active') is not None:
-                bot.active = body.get('active')
-
-            if body.get('strategy_id') is not None:
-                bot.strategy_id = body.get('strategy_id')
-            
-            if body.get('timeframe') is not None:
-                bot.timeframe = body.get('timeframe')
-
-            if body.get('param_values') is not None:
-                bot.param_values = body.get('param_values').split(', ')
-            
-            bot.update()
-
-            response = {
-                'success' : True,
-                'id' : bot.id,
-                'name' : bot.name,
-                'active' : bot.active,
-                'strategy_id' : bot.strategy_id,
-                'timeframe' : bot.timeframe,
-                'param_values' : [ val for val in bot.param_values ]
-            }
-
-            return jsonify(response), 200
-        
+            values = bot_values(body)
         except Exception:
             abort(400)
 
+        if active_writes is not None and is_toggle(values):
+            # Coalesced with the other toggles into one UPDATE and commit,
+            # Prefer: respond-async answers before the commit
+            future = active_writes.submit(bot_id, values['active'], payload.get('sub'))
+            replica_router.stick(payload.get('sub'))
+            if 'respond-async' in request.headers.get('Prefer', ''):
+                return jsonify({
+                    'success' : True,
+                    'id' : bot_id,
+                    'active' : values['active']
+                }), 202, {'Preference-Applied': 'respond-async'}
+            try:
+                bot = future.result(COALESCE_TIMEOUT)
+            except Exception:
+                abort(500)
+        else:
+            # One UPDATE ... RETURNING, no ORM load before the write
+            try:
+                bot = Bot.update_by_id(bot_id, values)
+            except Exception:
+                db.session.rollback()
+                abort(400)
+
+        if bot is None:
+            abort(404)
+
+        response = {
+            'success' : True,
+            'id' : bot.id,
+            'name' : bot.name,
+            'active' : bot.active,
+            'strategy_id' : bot.strategy_id,
+            'timeframe' : bot.timeframe,
+            'param_values' : bot.param_values
+        }
+
+        return jsonify(response), 200
+
     @app.route('/bots/<int:bot_id>', methods = ['DELETE'])
+    @query_budget(8)
     @requires_auth('delete:bots')
     def delete_bot(payload, bot_id):
         bot = Bot.query.filter(Bot.id == bot_id).one_or_none()
@@ -297,6 +574,14 @@ def create_app(test_config=None):
                         "message": "method not allowed"
                         }), 405
 
+    @app.errorhandler(410)
+    def gone(error):
+        return jsonify({
+                        "success": False, 
+                        "error": 410,
+                        "message": "sync token expired, sync again from scratch"
+                        }), 410
+
     @app.errorhandler(500)
     def servererror(error):
         return jsonify({
@@ -305,6 +590,13 @@ def create_app(test_config=None):
                         "message": "server error"
                         }), 500
 
+    @app.errorhandler(503)
+    def unavailable(error):
+        return jsonify({
+                        "success": False, 
+                        "error": 503,
+                        "message": "service unavailable"
+                        }), 503
 
     @app.errorhandler(AuthError)
     def autherror(error):
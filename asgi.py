@@ -0,0 +1,309 @@
+import os, time
+from functools import wraps
+from urllib.parse import parse_qsl
+
+import asyncpg
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_etags, quote_etag
+
+import auth
+from auth import AuthError, check_permissions, parse_auth_header
+from etags import make_etag
+from filters import parse_bot_filters
+from metrics import REQUEST_SECONDS, REQUESTS, SQL_STATEMENTS, SQL_SECONDS
+from pagination import Page
+from pool import PGBOUNCER
+
+DATABASE_URL = os.environ['DATABASE_URL']
+ASYNC_POOL_MIN_SIZE = int(os.environ.get('ASYNC_POOL_MIN_SIZE', 2))
+ASYNC_POOL_MAX_SIZE = int(os.environ.get('ASYNC_POOL_MAX_SIZE', 20))
+
+ERROR_MESSAGES = {
+    400: 'bad request',
+    401: 'not authorized',
+    403: 'forbidden',
+    404: 'resource not found',
+    405: 'method not allowed',
+    500: 'server error'
+}
+
+# Query parameters only the Flask routes implement
+DELEGATED_PARAMS = {'fields', 'since', 'stream', 'where'}
+
+
+'''
+ASGI deployment mode
+
+    Serves the API from an event loop, e.g.
+        gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+
+    - GET on the listing routes runs natively async: asyncpg for the
+      database, token checks off the event loop, same pagination, filters,
+      ETags, error bodies and requires_auth semantics as the Flask routes
+    - Every other request (writes, ?fields=, ?since=, ?where=, NDJSON streaming) goes
+      to the Flask app from create_app, run in a thread pool
+    - The async listings are in the request and SQL metrics of metrics.py,
+      under the same labels, but they
+        + read from DATABASE_URL only, never from the read replica
+          (replica.py) and not in db_reads_total
+        + do not go through the response cache (response_cache.py), a
+          304 still skips the listing query
+        + have no query budget (querycount.py), they run two statements
+'''
+
+'''
+Errors
+Same JSON bodies as the Flask error handlers
+'''
+
+def error_response(status, message=None):
+    return JSONResponse({
+        'success': False,
+        'error': status,
+        'message': message or ERROR_MESSAGES.get(status, 'server error')
+    }, status_code=status)
+
+
+async def http_error(request, error):
+    return error_response(error.code)
+
+
+async def auth_error(request, error):
+    return error_response(error.status_code, error.error['description'])
+
+
+async def server_error(request, error):
+    return error_response(500)
+
+
+'''
+@requires_auth_async(permission) decorator method
+
+    Required inputs:
+        permission: string permission ('get:bots')
+
+    - Same checks as auth.requires_auth
+    - A token already in the verified token cache is checked inline, a new
+      one is verified in the thread pool (JWKS fetch and RS256), so the
+      event loop never blocks on Auth0
+'''
+
+def requires_auth_async(permission=''):
+    def requires_auth_decorator(f):
+        @wraps(f)
+        async def wrapper(request):
+            token = parse_auth_header(request.headers.get('Authorization'))
+            cached = auth.token_cache.get(token)
+            if cached is None:
+                payload = await run_in_threadpool(auth.verify_decode_jwt, token)
+                cached = auth.token_cache.put(token, payload)
+            payload, permissions = cached
+            check_permissions(permission, payload, permissions)
+            return await f(request)
+        return wrapper
+    return requires_auth_decorator
+
+
+'''
+Listings
+SQL for each listing route, rows come back with the keys of the Flask records
+'''
+
+STRATEGIES = 'SELECT strategy.id, strategy.name FROM strategy'
+STRATEGIES_DETAIL = 'SELECT strategy.id, strategy.name, strategy.params FROM strategy'
+BOTS = 'SELECT bot.id, bot.name, bot.active FROM bot'
+BOTS_DETAIL = '''SELECT bot.id, bot.name, bot.active, strategy.name AS strategy,
+    bot.strategy_id, bot.timeframe, strategy.params, bot.param_values
+FROM bot LEFT OUTER JOIN strategy ON strategy.id = bot.strategy_id'''
+
+
+def bot_conditions(query_params, args):
+    filters = parse_bot_filters(query_params)
+    conditions = []
+
+    if 'ids' in filters:
+        args.append(filters['ids'])
+        conditions.append(f'bot.id = ANY(${len(args)})')
+
+    for name in ('strategy_id', 'timeframe', 'active'):
+        if name in filters:
+            args.append(filters[name])
+            conditions.append(f'bot.{name} = ${len(args)}')
+
+    return conditions
+
+
+async def fetch(request, connection, sql, *args):
+    started = time.perf_counter()
+    try:
+        return await connection.fetch(sql, *args)
+    finally:
+        counts = request.scope.get('sql')
+        if counts is not None:
+            counts['statements'] += 1
+            counts['seconds'] += time.perf_counter() - started
+
+
+async def listing(request, sql, key, tables, filtered=False):
+    query_params = request.query_params
+    page = Page.from_args(query_params)
+    args = []
+    conditions = bot_conditions(query_params, args) if filtered else []
+
+    if page.enabled:
+        if page.after is not None:
+            args.append(page.after)
+            conditions.append(f'{key} > ${len(args)}')
+        args.append(page.limit + 1)
+
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    if page.enabled:
+        sql += f' ORDER BY {key} LIMIT ${len(args)}'
+
+    pool = request.app.state.pool
+    async with pool.acquire() as connection:
+        rows = await fetch(request, connection,
+            'SELECT name, version FROM table_version WHERE name = ANY($1)', list(tables))
+        versions = dict.fromkeys(tables, 0)
+        versions.update((row['name'], row['version']) for row in rows)
+
+        variant = f'{request.url.path}?{request.url.query}|{request.headers.get("Accept", "")}'
+        etag = make_etag(versions, tables, variant)
+        headers = {'ETag': quote_etag(etag)}
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match and parse_etags(if_none_match).contains(etag):
+            return Response(status_code=304, headers=headers)
+
+        rows = await fetch(request, connection, sql, *args)
+
+    if page.enabled:
+        rows = page.trim(rows, lambda row: row['id'])
+    records = [dict(row) for row in rows]
+    return JSONResponse(page.body(records), headers=headers)
+
+
+async def greet(request):
+    return JSONResponse({
+        'message': 'Welcome to Trading Bot App! Public endpoints are /strategies and /bots, use JWT tokens provided for all other ones.'
+    })
+
+
+async def get_strategies(request):
+    return await listing(request, STRATEGIES, 'strategy.id', ('strategy',))
+
+
+@requires_auth_async('get:strategies')
+async def get_strategies_detail(request):
+    return await listing(request, STRATEGIES_DETAIL, 'strategy.id', ('strategy',))
+
+
+async def get_bots(request):
+    return await listing(request, BOTS, 'bot.id', ('bot',), filtered=True)
+
+
+@requires_auth_async('get:bots')
+async def get_bots_details(request):
+    return await listing(request, BOTS_DETAIL, 'bot.id', ('bot', 'strategy'), filtered=True)
+
+
+'''
+instrumented(app)
+
+    - Records the requests of an ASGI app in the request and SQL metrics,
+      as init_metrics does for Flask; the fast routes have no parameters,
+      so the path is the endpoint label
+'''
+
+def instrumented(app):
+    async def wrapper(scope, receive, send):
+        if scope['type'] != 'http':
+            return await app(scope, receive, send)
+
+        started = time.perf_counter()
+        scope['sql'] = {'statements': 0, 'seconds': 0.0}
+        status = [500]
+
+        async def send_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        try:
+            await app(scope, receive, send_status)
+        finally:
+            endpoint, method = scope['path'], scope['method']
+            REQUEST_SECONDS.labels(endpoint, method).observe(time.perf_counter() - started)
+            REQUESTS.labels(endpoint, method, status[0]).inc()
+            SQL_STATEMENTS.labels(endpoint).observe(scope['sql']['statements'])
+            SQL_SECONDS.labels(endpoint).observe(scope['sql']['seconds'])
+    return wrapper
+
+
+'''
+create_asgi_app(flask_app=None)
+
+    - Builds the async listing routes, with an asyncpg pool opened on
+      startup, and falls back to flask_app (the one in app.py by default)
+      for everything else
+'''
+
+def create_asgi_app(flask_app=None):
+    if flask_app is None:
+        from app import app as flask_app
+
+    async def open_pool():
+        fast.state.pool = await asyncpg.create_pool(
+            DATABASE_URL, min_size=ASYNC_POOL_MIN_SIZE, max_size=ASYNC_POOL_MAX_SIZE,
+            # PgBouncer hands each transaction a different server connection
+            statement_cache_size=0 if PGBOUNCER else 100)
+
+    async def close_pool():
+        await fast.state.pool.close()
+
+    fast = Starlette(
+        routes=[
+            Route('/', greet),
+            Route('/strategies', get_strategies),
+            Route('/strategies-detail', get_strategies_detail),
+            Route('/bots', get_bots),
+            Route('/bots-detail', get_bots_details),
+        ],
+        exception_handlers={
+            HTTPException: http_error,
+            AuthError: auth_error,
+            Exception: server_error
+        },
+        on_startup=[open_pool],
+        on_shutdown=[close_pool]
+    )
+    fast_paths = {route.path for route in fast.routes}
+    fast_app = instrumented(
+        CORSMiddleware(fast, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']))
+    wsgi_app = WSGIMiddleware(flask_app)
+
+    def is_fast(scope):
+        if scope['method'] not in ('GET', 'HEAD') or scope['path'] not in fast_paths:
+            return False
+        params = {name for name, _ in parse_qsl(scope['query_string'].decode())}
+        if params & DELEGATED_PARAMS:
+            return False
+        accept = dict(scope['headers']).get(b'accept', b'')
+        return b'application/x-ndjson' not in accept
+
+    async def app(scope, receive, send):
+        if scope['type'] == 'http' and not is_fast(scope):
+            await wsgi_app(scope, receive, send)
+        else:
+            await fast_app(scope, receive, send)
+
+    return app
+
+
+app = create_asgi_app()
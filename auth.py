@@ -1,8 +1,10 @@
-import json, os
-from flask import request, _request_ctx_stack, abort
+import hashlib, json, os, threading, time
+from collections import OrderedDict
+from flask import request, _request_ctx_stack, abort, g
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
+from metrics import JWT_VERIFY_SECONDS
 
 # Get environment variables
 
@@ -10,6 +12,13 @@ AUTH_DOMAIN = 'botfsnd.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'capstone'
 
+JWKS_URL = os.environ.get('JWKS_URL', f'https://{AUTH_DOMAIN}/.well-known/jwks.json')
+JWKS_FILE = os.environ.get('JWKS_FILE')
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 3600))
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = int(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 4096))
+
 
 ## AuthError exception handler
 
@@ -31,10 +40,15 @@ get_token_auth_header() method
         + Raises an AuthError if the header is malformed
 
     - Returns the token part of the header
+    - parse_auth_header(auth) does the checks on the header value, outside
+      of a Flask request (ASGI mode)
 '''
 
 def get_token_auth_header():
-    auth = request.headers.get('Authorization', None)
+    return parse_auth_header(request.headers.get('Authorization', None))
+
+
+def parse_auth_header(auth):
     if not auth:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -65,27 +79,159 @@ def get_token_auth_header():
 
 
 '''
-check_permissions(permission, payload) method
+check_permissions(permission, payload, permissions=None) method
 
     Inputs used:
         permission: string permission ('post:bots')
         payload: decoded jwt payload
+        permissions: (optional) precomputed frozenset of the payload permissions
 
     - Raises an AuthError if permissions are not included in the payload
     - Raises an AuthError if the requested permission string is not in the payload permissions array
     - Returns true otherwise
 '''
 
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
-        abort(401)
+def check_permissions(permission, payload, permissions=None):
+    if permissions is None:
+        if 'permissions' not in payload:
+            abort(401)
+        permissions = payload['permissions']
 
-    if permission not in payload['permissions']:
+    if permission not in permissions:
         abort(401)
 
     return True
 
 
+## JWKS key store
+
+'''
+JWKS fetchers
+
+    A fetcher is any callable taking no arguments and returning the parsed
+    jwks.json document ({'keys': [...]}).
+
+    - url_jwks_fetcher(url) fetches over HTTP(S), from Auth0 unless JWKS_URL
+      points to a stand-in key server
+    - file_jwks_fetcher(path) reads a local file (JWKS_FILE), handy for tests
+'''
+
+def url_jwks_fetcher(url=JWKS_URL, timeout=JWKS_FETCH_TIMEOUT):
+    def fetch():
+        jsonurl = urlopen(url, timeout=timeout)
+        return json.loads(jsonurl.read())
+    return fetch
+
+
+def file_jwks_fetcher(path):
+    def fetch():
+        with open(path) as jwks_file:
+            return json.load(jwks_file)
+    return fetch
+
+
+def default_jwks_fetcher():
+    if JWKS_FILE:
+        return file_jwks_fetcher(JWKS_FILE)
+    return url_jwks_fetcher()
+
+
+'''
+JWKSStore class
+
+    Keeps the signing keys in memory, indexed by key id (kid), so they are
+    fetched once per worker instead of once per request.
+
+    - get_key(kid) returns the RSA key for the kid
+        + an unknown kid forces one refetch, at most once every
+          min_refresh_interval seconds
+    - A daemon thread refreshes the keys every ttl seconds
+        + it is started lazily on first use, so it survives gunicorn forks
+    - A failed refresh keeps serving the keys already held
+'''
+
+class JWKSStore:
+    def __init__(self, fetcher=None, ttl=JWKS_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL, background=True):
+        self.fetcher = fetcher or default_jwks_fetcher()
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.background = background
+        self.fetch_count = 0
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._lock = threading.RLock()
+        self._thread = None
+        self._pid = None
+
+    def _load(self, jwks):
+        keys = {}
+        for key in jwks['keys']:
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+        return keys
+
+    def refresh(self, force=False):
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._last_attempt is not None \
+                    and now - self._last_attempt < self.min_refresh_interval:
+                return False
+            self._last_attempt = now
+            try:
+                keys = self._load(self.fetcher())
+            except Exception:
+                if self._keys:
+                    return False
+                raise
+            self.fetch_count += 1
+            self._keys = keys
+            self._fetched_at = now
+            return True
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.ttl)
+            try:
+                self.refresh(force=True)
+            except Exception:
+                pass
+
+    def _ensure_refresher(self):
+        # Threads do not survive a fork, so start one per process
+        if not self.background or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._refresh_loop, daemon=True)
+            self._thread.start()
+
+    def get_key(self, kid):
+        self._ensure_refresher()
+        if self._fetched_at is None:
+            with self._lock:
+                if self._fetched_at is None:
+                    self.refresh(force=True)
+        elif time.monotonic() - self._fetched_at > self.ttl:
+            self.refresh()
+
+        key = self._keys.get(kid)
+        if key is None and self.refresh():
+            key = self._keys.get(kid)
+        return key
+
+
+jwks_store = JWKSStore()
+
+
 '''
 verify_decode_jwt(token) method
 
@@ -94,37 +240,33 @@ verify_decode_jwt(token) method
 
     - Checks that the token complies with the following:
         + it should be an Auth0 token with key id (kid)
-        + it should verify the token using Auth0 /.well-known/jwks.json
+        + it should verify the token using the cached Auth0 /.well-known/jwks.json
         + it should decode the payload from the token
         + it should validate the claims
     - Returns a decoded payload
 '''
 
+@JWT_VERIFY_SECONDS.time()
 def verify_decode_jwt(token):
-    # Get public key from Auth0 - print jwks to get the json data from Auth0, check KID
-    jsonurl = urlopen(f'https://{AUTH_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    
     # Get header data - print this to check if KID matches Auth0's
     unverified_header = jwt.get_unverified_header(token)
     
     # Check the RSA key has the KID
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    # Get public key from the in-process JWKS store, refetched from Auth0 only when needed
+    try:
+        rsa_key = jwks_store.get_key(unverified_header['kid'])
+    except Exception:
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the signing keys.'
+        }, 503)
+
     if rsa_key:
         try:
             # Use KID to validate JWT
@@ -162,28 +304,126 @@ def verify_decode_jwt(token):
             }, 401)
 
 
+## Verified token cache
+
+'''
+TokenCache class
+
+    Bounded LRU of tokens that already passed verify_decode_jwt, keyed by the
+    SHA-256 digest of the token, so a reused bearer token skips the RS256
+    signature check.
+
+    - Each entry holds the decoded payload and a frozenset of its permissions
+    - Entries expire at the token exp claim, tokens without exp are not cached
+    - put(token, payload) returns (payload, permissions)
+    - hits, misses and evictions counters are kept for monitoring
+'''
+
+class TokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        key = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], entry[2]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, token, payload):
+        permissions = payload.get('permissions')
+        if permissions is not None:
+            permissions = frozenset(permissions)
+        exp = payload.get('exp')
+        if not isinstance(exp, (int, float)) or self.maxsize <= 0:
+            return payload, permissions
+
+        key = self.digest(token)
+        with self._lock:
+            self._entries[key] = (exp, payload, permissions)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return payload, permissions
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+token_cache = TokenCache()
+
+
+'''
+verify_decode_jwt_cached(token) method
+
+    - Returns (payload, permissions) from the token cache when the token was
+      already verified and has not expired
+    - Otherwise runs verify_decode_jwt and caches the result
+'''
+
+def verify_decode_jwt_cached(token):
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached
+
+    return token_cache.put(token, verify_decode_jwt(token))
+
+
 # Binding it all together - the decorator method
 
 '''
-@requires_auth(permission) decorator method
+@requires_auth(permission, *more) decorator method
 
     Required inputs:
         permission: string permission ('post:strategy')
+    Optional inputs:
+        more: further permissions the token must also carry ('patch:strategy')
 
     - The decorator performs the following methods:
         + The get_token_auth_header method to get the token
-        + The verify_decode_jwt method to decode the jwt
+        + The verify_decode_jwt_cached method to decode the jwt, or reuse an already verified one
         + The check_permissions method validate claims and check the requested permission
     - Then returns the decorator which passes the decoded payload to the decorated method
 '''
 
-def requires_auth(permission=''):
+def requires_auth(permission='', *more):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            payload, permissions = verify_decode_jwt_cached(token)
+            for required in (permission,) + more:
+                check_permissions(required, payload, permissions)
+            # Read-your-writes routing keys on the subject (see replica.py)
+            g.subject = payload.get('sub')
             return f(payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
@@ -0,0 +1,52 @@
+import json, timeit
+from flask import Flask
+
+import auth
+from benchmarks.local_auth import LocalAuth, TRADER_PERMISSIONS
+
+'''
+requires_auth micro-benchmark
+
+    Compares a cold call (token cache cleared, full RS256 verification) with a
+    warm call (token served from the verified token cache).
+
+    Run from the project root:
+        python -m benchmarks.bench_auth
+'''
+
+NUMBER = 2000
+
+
+def main():
+    local = LocalAuth().install()
+    token = local.token(TRADER_PERMISSIONS)
+    app = Flask(__name__)
+
+    @auth.requires_auth('get:bots')
+    def endpoint(payload):
+        return payload
+
+    headers = {'Authorization': f'Bearer {token}'}
+    with app.test_request_context(headers=headers):
+        def cold():
+            auth.token_cache.clear()
+            endpoint()
+
+        def warm():
+            endpoint()
+
+        cold_s = timeit.timeit(cold, number=NUMBER)
+        auth.token_cache.clear()
+        warm_s = timeit.timeit(warm, number=NUMBER)
+
+    print(json.dumps({
+        'iterations': NUMBER,
+        'cold_us_per_call': cold_s / NUMBER * 1e6,
+        'warm_us_per_call': warm_s / NUMBER * 1e6,
+        'speedup': cold_s / warm_s,
+        'token_cache': auth.token_cache.stats()
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
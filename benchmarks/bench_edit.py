@@ -0,0 +1,83 @@
+import json, time
+from sqlalchemy import event
+
+from flask import jsonify, request
+
+from app import create_app
+from auth import requires_auth
+from models import db, Strategy, Bot
+from benchmarks.local_auth import LocalAuth, TRADER_PERMISSIONS
+
+'''
+PATCH /bots/<id> benchmark
+
+    Compares the single UPDATE ... RETURNING write path of edit_bot with the
+    former ORM path (SELECT, mutate, commit) mounted on a benchmark-only
+    route, both toggling active on one bot through the full request stack.
+    Needs the database in DATABASE_URL, rows 900000 are created and removed.
+
+    Run from the project root:
+        python -m benchmarks.bench_edit
+'''
+
+NUMBER = 1000
+BOT_ID = 900000
+
+
+def add_orm_route(app):
+    @app.route('/benchmark/orm-bots/<int:bot_id>', methods = ['PATCH'])
+    @requires_auth('patch:bots')
+    def orm_edit_bot(payload, bot_id):
+        bot = Bot.query.filter(Bot.id == bot_id).one_or_none()
+        bot.active = request.get_json().get('active')
+        bot.update()
+        return jsonify(bot.format()), 200
+
+
+def measure(run):
+    statements = []
+
+    def count(*args):
+        statements.append(args[2])
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    start = time.perf_counter()
+    for i in range(NUMBER):
+        run(i % 2 == 0)
+    elapsed = time.perf_counter() - start
+    event.remove(db.engine, 'before_cursor_execute', count)
+    return {
+        'us_per_request': elapsed / NUMBER * 1e6,
+        'statements_per_request': len(statements) / NUMBER
+    }
+
+
+def main():
+    app = create_app()
+    add_orm_route(app)
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer ' + LocalAuth().install().token(TRADER_PERMISSIONS)}
+
+    with app.app_context():
+        Strategy(id=BOT_ID, name='Benchmark', params=['window']).insert()
+        Bot(id=BOT_ID, name='Benchmark', active=True, timeframe='1h',
+            strategy_id=BOT_ID, param_values=['7']).insert()
+        try:
+            returning = measure(lambda active: client.patch(
+                f'/bots/{BOT_ID}', json={'active': active}, headers=headers))
+            orm = measure(lambda active: client.patch(
+                f'/benchmark/orm-bots/{BOT_ID}', json={'active': active}, headers=headers))
+        finally:
+            Bot.query.filter(Bot.id == BOT_ID).delete()
+            Strategy.query.filter(Strategy.id == BOT_ID).delete()
+            db.session.commit()
+
+    print(json.dumps({
+        'iterations': NUMBER,
+        'update_returning': returning,
+        'orm_load_mutate_commit': orm
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import json, os, time, tracemalloc
+
+from app import create_app
+from models import db, Strategy, Bot
+from benchmarks.local_auth import LocalAuth, TRADER_PERMISSIONS
+
+'''
+Sparse fieldset benchmark
+
+    Compares GET /bots-detail returning every column with the sparse
+    ?fields=id,active path, in latency and peak Python memory per request.
+    Needs the database in DATABASE_URL, a fleet of BENCH_BOTS bots (50k by
+    default) is created under strategy 2000000 and removed afterwards.
+
+    Run from the project root:
+        python -m benchmarks.bench_fields
+'''
+
+BOTS = int(os.environ.get('BENCH_BOTS', 50000))
+REPEAT = 5
+FIRST_ID = 2000000
+
+
+def seed():
+    Strategy(id=FIRST_ID, name='Benchmark', params=['window', 'stop_loss']).insert()
+    Bot.bulk_insert([{
+        'id': FIRST_ID + i,
+        'name': f'Bot {i}',
+        'active': i % 2 == 0,
+        'strategy_id': FIRST_ID,
+        'timeframe': '1h',
+        'param_values': [str(i % 100), '0.02']
+    } for i in range(BOTS)])
+
+
+def cleanup():
+    Bot.query.filter(Bot.strategy_id == FIRST_ID).delete()
+    Strategy.query.filter(Strategy.id == FIRST_ID).delete()
+    db.session.commit()
+
+
+def measure(client, url, headers):
+    timings, peaks = [], []
+    for _ in range(REPEAT):
+        tracemalloc.start()
+        start = time.perf_counter()
+        res = client.get(url, headers=headers)
+        timings.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        assert res.status_code == 200
+    return {
+        'ms_per_request': min(timings) * 1e3,
+        'peak_mb': max(peaks) / 2 ** 20,
+        'bytes': len(res.data)
+    }
+
+
+def main():
+    app = create_app()
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer ' + LocalAuth().install().token(TRADER_PERMISSIONS)}
+    url = f'/bots-detail?strategy_id={FIRST_ID}'
+
+    with app.app_context():
+        seed()
+        try:
+            results = {
+                'bots': BOTS,
+                'all_fields': measure(client, url, headers),
+                'fields_id_active': measure(client, url + '&fields=id,active', headers)
+            }
+        finally:
+            cleanup()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
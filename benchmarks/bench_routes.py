@@ -0,0 +1,198 @@
+import argparse, asyncio, itertools, json, os, random, subprocess, sys, time
+from collections import deque
+
+import httpx
+from flask_migrate import Migrate, upgrade
+
+from app import create_app
+from models import db, Strategy, Bot
+from benchmarks.load_test import drive
+from benchmarks.local_auth import LocalAuth, TRADER_PERMISSIONS, QUANT_MANAGER_PERMISSIONS
+
+'''
+Full stack route benchmark
+
+    Runs the whole app offline and drives every route with concurrent
+    clients, then reports p50/p95/p99 latency and throughput per route.
+    - the schema of the database in DATABASE_URL is upgraded, a fleet of
+      --bots bots over --strategies strategies is seeded from id 3000000
+      and removed afterwards
+    - gunicorn serves app:app (or asgi:app with --asgi) in a subprocess,
+      with JWKS_URL pointing at a local stand-in for Auth0, and tokens are
+      signed with its key
+    - --out writes the results as a JSON baseline, --compare reads one and
+      exits with 1 when a route got slower (p95) or handles fewer requests
+      per second by more than --threshold
+
+    Run from the project root:
+        python -m benchmarks.bench_routes --bots 10000 --out baseline.json
+        python -m benchmarks.bench_routes --bots 10000 --compare baseline.json
+'''
+
+FIRST_ID = 3000000
+SEED_CHUNK = 10000
+PAGE = 100
+
+
+def seed(bots, strategies):
+    for i in range(strategies):
+        Strategy(id=FIRST_ID + i, name=f'Benchmark {i}', params=['window', 'stop_loss']).insert()
+    for start in range(0, bots, SEED_CHUNK):
+        Bot.bulk_insert([{
+            'id': FIRST_ID + i,
+            'name': f'Bot {i}',
+            'active': i % 2 == 0,
+            'strategy_id': FIRST_ID + i % strategies,
+            'timeframe': '1h',
+            'param_values': [str(i % 100), '0.02']
+        } for i in range(start, min(start + SEED_CHUNK, bots))])
+
+
+def cleanup():
+    Bot.query.filter(Bot.id >= FIRST_ID).delete(synchronize_session=False)
+    Strategy.query.filter(Strategy.id >= FIRST_ID).delete(synchronize_session=False)
+    db.session.commit()
+
+
+'''
+Routes
+    (name, role, make_request) for every route, make_request() returns the
+    next (method, url, body). Writes create their own bots, and the deletes
+    that run after them remove those.
+'''
+
+def routes(bots):
+    fleet = range(FIRST_ID, FIRST_ID + bots)
+    new_ids = itertools.count(FIRST_ID + bots)
+    created = deque()
+
+    def new_bot():
+        bot_id = next(new_ids)
+        created.append(bot_id)
+        return {'id': bot_id, 'name': f'Bot {bot_id}', 'active': True,
+                'strategy_id': FIRST_ID, 'timeframe': '4h', 'param_values': '10, 0.01'}
+
+    def pop_ids(count):
+        return ','.join(str(created.popleft()) for _ in range(min(count, len(created)))) or '0'
+
+    def get(url):
+        return lambda: ('GET', url, None)
+
+    return [
+        ('GET /', None, get('/')),
+        ('GET /strategies', None, get('/strategies')),
+        ('GET /strategies-detail', 'trader', get('/strategies-detail')),
+        ('GET /bots', None, get('/bots')),
+        ('GET /bots?limit', None, get(f'/bots?limit={PAGE}')),
+        ('GET /bots-detail', 'trader', get('/bots-detail')),
+        ('GET /bots-detail?limit', 'trader', get(f'/bots-detail?limit={PAGE}')),
+        ('GET /bots-detail?strategy_id', 'trader',
+         get(f'/bots-detail?strategy_id={FIRST_ID}&limit={PAGE}')),
+        ('GET /bots-detail?fields', 'trader', get('/bots-detail?fields=id,active')),
+        ('GET /bots/search', 'trader', get(f'/bots/search?where=window<10&limit={PAGE}')),
+        ('PATCH /bots/<id>', 'trader', lambda: (
+            'PATCH', f'/bots/{random.choice(fleet)}', {'active': random.random() < 0.5})),
+        ('PATCH /bots', 'trader', lambda: (
+            'PATCH', f'/bots?ids={",".join(map(str, random.sample(fleet, 10)))}',
+            {'active': random.random() < 0.5})),
+        ('PATCH /strategies/<id>', 'quant', lambda: (
+            'PATCH', f'/strategies/{FIRST_ID}', {'name': f'Benchmark {random.random()}'})),
+        ('POST /bots/create', 'quant', lambda: ('POST', '/bots/create', new_bot())),
+        ('POST /bots/bulk', 'quant', lambda: ('POST', '/bots/bulk', [new_bot() for _ in range(PAGE)])),
+        ('DELETE /bots/<id>', 'quant', lambda: ('DELETE', f'/bots/{pop_ids(1)}', None)),
+        ('DELETE /bots', 'quant', lambda: ('DELETE', f'/bots?ids={pop_ids(10)}', None)),
+    ]
+
+
+def start_server(args, jwks_url):
+    target = ['asgi:app', '-k', 'uvicorn.workers.UvicornWorker'] if args.asgi else ['app:app']
+    env = {**os.environ, 'JWKS_URL': jwks_url}
+    server = subprocess.Popen(
+        ['gunicorn', *target, '-w', str(args.workers), '-b', f'127.0.0.1:{args.port}'], env=env)
+    base_url = f'http://127.0.0.1:{args.port}'
+    for _ in range(100):
+        try:
+            httpx.get(base_url + '/')
+            return server, base_url
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('server did not start')
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results['routes'].items():
+        before = baseline['routes'].get(name)
+        if not before or not result['p95_ms'] or not before['p95_ms']:
+            continue
+        p95 = result['p95_ms'] / before['p95_ms'] - 1
+        throughput = result['throughput_rps'] / before['throughput_rps'] - 1
+        result['p95_change'] = round(p95, 3)
+        result['throughput_change'] = round(throughput, 3)
+        if p95 > threshold or throughput < -threshold:
+            regressions.append(name)
+    results['regressions'] = regressions
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Full stack route benchmark')
+    parser.add_argument('--bots', type=int, default=1000)
+    parser.add_argument('--strategies', type=int, default=10)
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    parser.add_argument('-d', '--duration', type=float, default=10)
+    parser.add_argument('-w', '--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--asgi', action='store_true')
+    parser.add_argument('--out')
+    parser.add_argument('--compare')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args()
+
+    local = LocalAuth()
+    headers = {
+        None: {},
+        'trader': {'Authorization': f'Bearer {local.token(TRADER_PERMISSIONS)}'},
+        'quant': {'Authorization': f'Bearer {local.token(QUANT_MANAGER_PERMISSIONS)}'}
+    }
+
+    app = create_app()
+    Migrate(app, db)
+    with app.app_context():
+        upgrade()
+        cleanup()
+        seed(args.bots, args.strategies)
+
+    server, base_url = start_server(args, local.serve())
+    try:
+        results = {
+            'bots': args.bots,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'workers': args.workers,
+            'asgi': args.asgi,
+            'routes': {}
+        }
+        for name, role, make_request in routes(args.bots):
+            results['routes'][name] = asyncio.run(drive(
+                make_request, args.concurrency, args.duration, headers[role], base_url))
+    finally:
+        server.terminate()
+        server.wait()
+        with app.app_context():
+            cleanup()
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
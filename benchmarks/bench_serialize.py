@@ -0,0 +1,97 @@
+import json, time
+from collections import namedtuple
+
+import flask
+
+import serializers
+from app import create_app
+from fields import BOT_DETAIL_FIELDS
+from models import Strategy, Bot
+
+'''
+Serialization benchmark
+
+    Compares building and serializing a /bots-detail body the former way
+    (ORM entities, records with copied lists, flask.jsonify) with the
+    serializers path (row tuples, records zipped from the tuple, orjson),
+    and with the json fallback of serializers, at 1k, 10k and 100k rows.
+    Rows are built in memory, DATABASE_URL has to be set but the database
+    is not used, so only serialization is measured.
+
+    Run from the project root:
+        python -m benchmarks.bench_serialize
+'''
+
+SIZES = (1000, 10000, 100000)
+REPEAT = 5
+NAMES = list(BOT_DETAIL_FIELDS.columns)
+Row = namedtuple('Row', NAMES)
+
+
+def entities(count):
+    strategy = Strategy(id=1, name='Benchmark', params=['window', 'stop_loss'])
+    return [Bot(id=i, name=f'Bot {i}', active=i % 2 == 0, timeframe='1h',
+                param_values=[str(i % 100), '0.02'], strategy=strategy)
+            for i in range(count)]
+
+
+def rows(count):
+    params = ['window', 'stop_loss']
+    return [Row(i, f'Bot {i}', i % 2 == 0, 'Benchmark', 1, '1h', params, [str(i % 100), '0.02'])
+            for i in range(count)]
+
+
+def former_record(bot):
+    strategy = bot.strategy
+    return {
+        'id' : bot.id,
+        'name' : bot.name,
+        'active' : bot.active,
+        'strategy' : strategy.name,
+        'strategy_id' : bot.strategy_id,
+        'timeframe' : bot.timeframe,
+        'params' : [ par for par in strategy.params ],
+        'param_values' : [ val for val in bot.param_values ],
+    }
+
+
+def former(bots):
+    return flask.jsonify([former_record(bot) for bot in bots]).get_data()
+
+
+def current(tuples, dumps):
+    record = BOT_DETAIL_FIELDS.serializer(NAMES)
+    return dumps([record(row) for row in tuples])
+
+
+def measure(run):
+    timings = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        body = run()
+        timings.append(time.perf_counter() - start)
+    return {'ms': round(min(timings) * 1e3, 2), 'bytes': len(body)}
+
+
+def json_dumps(obj):
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def main():
+    app = create_app()
+    results = {'orjson': serializers.orjson is not None, 'sizes': {}}
+    with app.test_request_context():
+        for size in SIZES:
+            bots, tuples = entities(size), rows(size)
+            result = {
+                'former': measure(lambda: former(bots)),
+                'serializers': measure(lambda: current(tuples, serializers.dumps)),
+                'serializers_json': measure(lambda: current(tuples, json_dumps))
+            }
+            result['speedup'] = round(result['former']['ms'] / result['serializers']['ms'], 1)
+            results['sizes'][size] = result
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
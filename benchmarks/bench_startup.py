@@ -0,0 +1,63 @@
+import json, statistics, subprocess, sys
+
+'''
+Worker cold start benchmark
+
+    Starts RUNS fresh interpreters, each one doing what a gunicorn worker
+    does before it serves (import the app, warm_up), then times the first
+    request. Compares the first request with and without the warm-up.
+
+    Run from the project root:
+        python -m benchmarks.bench_startup
+'''
+
+RUNS = 5
+
+WORKER = '''
+import json, time
+start = time.perf_counter()
+from benchmarks.local_auth import LocalAuth, TRADER_PERMISSIONS
+local = LocalAuth().install()
+from app import app
+loaded = time.perf_counter()
+timings = {}
+if WARM:
+    from warmup import warm_up
+    timings = warm_up(app)
+ready = time.perf_counter()
+headers = {'Authorization': f'Bearer {local.token(TRADER_PERMISSIONS)}'}
+app.test_client().get('/bots-detail?limit=10', headers=headers)
+done = time.perf_counter()
+print(json.dumps({
+    'import_ms': (loaded - start) * 1e3,
+    'warm_up_ms': (ready - loaded) * 1e3,
+    'first_request_ms': (done - ready) * 1e3,
+    'steps': timings
+}))
+'''
+
+
+def run(warm):
+    code = f'WARM = {warm}\n' + WORKER
+    out = subprocess.run([sys.executable, '-c', code], check=True,
+                         capture_output=True, text=True).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+def summarize(runs):
+    return {
+        name: round(statistics.median(run[name] for run in runs), 3)
+        for name in ('import_ms', 'warm_up_ms', 'first_request_ms')
+    }
+
+
+def main():
+    result = {
+        'cold': summarize([run(False) for _ in range(RUNS)]),
+        'warm': summarize([run(True) for _ in range(RUNS)])
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
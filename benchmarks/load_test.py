@@ -0,0 +1,90 @@
+import argparse, asyncio, json, time
+
+import httpx
+
+'''
+HTTP load test
+
+    Drives a running server with a fixed number of concurrent clients for a
+    fixed time and reports throughput and latency percentiles, e.g. to compare
+    the sync and async deployments of the same app:
+
+        gunicorn app:app -w 4 -b :8000
+        gunicorn asgi:app -w 4 -b :8001 -k uvicorn.workers.UvicornWorker
+
+        python -m benchmarks.load_test http://localhost:8000/bots -c 256
+        python -m benchmarks.load_test http://localhost:8001/bots -c 256
+
+    Pass --token for the authenticated routes.
+'''
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(latencies, errors, elapsed):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1e3 if latencies else None,
+        'p95_ms': percentile(latencies, 0.95) * 1e3 if latencies else None,
+        'p99_ms': percentile(latencies, 0.99) * 1e3 if latencies else None
+    }
+
+
+async def worker(client, make_request, headers, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        method, url, body = make_request()
+        start = time.perf_counter()
+        try:
+            res = await client.request(method, url, headers=headers, json=body)
+            if res.status_code >= 400:
+                errors[0] += 1
+        except httpx.HTTPError:
+            errors[0] += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+async def drive(make_request, concurrency, duration, headers=None, base_url=''):
+    # make_request() returns the (method, url, json body or None) to send next
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    latencies, errors = [], [0]
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        start = time.perf_counter()
+        deadline = start + duration
+        await asyncio.gather(*(
+            worker(client, make_request, headers or {}, deadline, latencies, errors)
+            for _ in range(concurrency)
+        ))
+        elapsed = time.perf_counter() - start
+
+    return summarize(latencies, errors[0], elapsed)
+
+
+async def run(url, concurrency, duration, token=None):
+    headers = {'Authorization': f'Bearer {token}'} if token else {}
+    return await drive(lambda: ('GET', url, None), concurrency, duration, headers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP load test')
+    parser.add_argument('url')
+    parser.add_argument('-c', '--concurrency', type=int, default=64)
+    parser.add_argument('-d', '--duration', type=float, default=10)
+    parser.add_argument('--token')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args.url, args.concurrency, args.duration, args.token))
+    result.update({'url': args.url, 'concurrency': args.concurrency})
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
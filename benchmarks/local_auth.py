@@ -0,0 +1,94 @@
+import base64, json, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwt
+
+import auth
+
+'''
+Local Auth0 stand-in
+
+    Generates an RSA key pair in memory, publishes it as a jwks.json document
+    and signs tokens that pass verify_decode_jwt, so benchmarks and tests run
+    without live Auth0 tokens.
+
+    - install() points the auth module of this process at the key pair
+    - serve() publishes the jwks.json over HTTP for a server started in
+      another process (JWKS_URL)
+'''
+
+TRADER_PERMISSIONS = ['get:bots', 'get:strategies', 'patch:bots']
+QUANT_MANAGER_PERMISSIONS = [
+    'delete:bots', 'delete:strategies', 'get:bots', 'get:strategies',
+    'patch:bots', 'patch:strategies', 'post:bots', 'post:strategies'
+]
+
+
+def _b64(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+class LocalAuth:
+    def __init__(self, kid='local-key'):
+        self.kid = kid
+        self.private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048, backend=default_backend())
+        self.private_pem = self.private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        ).decode()
+
+    def jwks(self):
+        numbers = self.private_key.public_key().public_numbers()
+        return {
+            'keys': [{
+                'kty': 'RSA',
+                'kid': self.kid,
+                'use': 'sig',
+                'alg': 'RS256',
+                'n': _b64(numbers.n),
+                'e': _b64(numbers.e)
+            }]
+        }
+
+    def token(self, permissions, subject='auth0|local', expires_in=3600):
+        now = int(time.time())
+        claims = {
+            'iss': 'https://' + auth.AUTH_DOMAIN + '/',
+            'sub': subject,
+            'aud': auth.API_AUDIENCE,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': permissions
+        }
+        return jwt.encode(claims, self.private_pem, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+    def install(self):
+        # Point the auth module at this key pair, with fresh caches
+        auth.jwks_store = auth.JWKSStore(fetcher=self.jwks, background=False)
+        auth.token_cache = auth.TokenCache()
+        return self
+
+    def serve(self, host='127.0.0.1', port=0):
+        # Returns the JWKS_URL of a stand-in for the Auth0 endpoint
+        body = json.dumps(self.jwks()).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return f'http://{host}:{server.server_port}/.well-known/jwks.json'
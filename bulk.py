@@ -0,0 +1,139 @@
+import json, os
+from flask import abort, request
+
+MAX_BULK_ROWS = int(os.environ.get('MAX_BULK_ROWS', 10000))
+
+
+'''
+read_bulk_rows() method
+
+    - Reads the request body as a JSON array of objects, or as NDJSON (one
+      object per line) when the Content-Type is application/x-ndjson
+    - Aborts with 400 on a malformed body or more than MAX_BULK_ROWS rows
+    - Returns the list of rows
+'''
+
+def read_bulk_rows():
+    if request.mimetype == 'application/x-ndjson':
+        rows = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                abort(400)
+    else:
+        rows = request.get_json(silent=True)
+
+    if not isinstance(rows, list) or not rows or len(rows) > MAX_BULK_ROWS:
+        abort(400)
+    return rows
+
+
+'''
+Row validators
+
+    Each validator takes one row of a bulk request and returns (values, errors)
+    - values is the dict of column values ready for bulk_insert
+    - errors is a list of messages, empty when the row is valid
+    - params and param_values take a list or a ', ' separated string, as in
+      the single create routes
+'''
+
+def _split(value):
+    if isinstance(value, str):
+        return value.split(', ')
+    if isinstance(value, list) and all(isinstance(v, str) for v in value):
+        return value
+    return None
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _check_id(row, errors):
+    # An invalid id comes back as None, so it is left out of the repeat check
+    row_id = row.get('id')
+    if row_id is not None and not _is_int(row_id):
+        errors.append('id must be an integer')
+        return None
+    return row_id
+
+
+def _check_string(row, field, max_length, errors):
+    value = row.get(field)
+    if not isinstance(value, str) or not value or len(value) > max_length:
+        errors.append(f'{field} must be a string of 1 to {max_length} characters')
+    return value
+
+
+def validate_strategy(row):
+    errors = []
+    if not isinstance(row, dict):
+        return None, ['row must be an object']
+
+    values = {
+        'id': _check_id(row, errors),
+        'name': _check_string(row, 'name', 50, errors),
+        'params': _split(row.get('params'))
+    }
+    if values['params'] is None:
+        errors.append('params must be a list or a comma separated string')
+    return values, errors
+
+
+def validate_bot(row, strategy_ids):
+    errors = []
+    if not isinstance(row, dict):
+        return None, ['row must be an object']
+
+    values = {
+        'id': _check_id(row, errors),
+        'name': _check_string(row, 'name', 20, errors),
+        'active': row.get('active'),
+        'strategy_id': row.get('strategy_id'),
+        'timeframe': _check_string(row, 'timeframe', 5, errors),
+        'param_values': _split(row.get('param_values'))
+    }
+    if not isinstance(values['active'], bool):
+        errors.append('active must be a boolean')
+    if not _is_int(values['strategy_id']) or values['strategy_id'] not in strategy_ids:
+        errors.append('strategy_id must reference an existing strategy')
+    if values['param_values'] is None:
+        errors.append('param_values must be a list or a comma separated string')
+    return values, errors
+
+
+'''
+validate_rows(rows, validate) method
+
+    - Runs the validator on every row and flags ids repeated within the batch
+    - Returns (values, results)
+        + values: the rows ready for bulk_insert, or None if any row failed
+        + results: per-row {'index', 'success', 'errors'} for the failed rows
+'''
+
+def validate_rows(rows, validate):
+    values, results = [], []
+    seen = set()
+    for index, row in enumerate(rows):
+        row_values, errors = validate(row)
+        row_id = row_values.get('id') if row_values else None
+        if row_id is not None:
+            if row_id in seen:
+                errors.append('id is repeated in the request')
+            seen.add(row_id)
+
+        if errors:
+            results.append({
+                'index': index,
+                'success': False,
+                'errors': errors
+            })
+        values.append(row_values)
+
+    if results:
+        return None, results
+    return values, results
@@ -0,0 +1,153 @@
+import json, os, select, threading, time
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
+from models import db, TableVersion, CHANGES_CHANNEL, ROW_CHANGES_CHANNEL, change_hooks
+from pool import PGBOUNCER
+
+CHANGES_POLL_INTERVAL = float(os.environ.get('CHANGES_POLL_INTERVAL', 2))
+# Direct connection to Postgres for LISTEN when DATABASE_URL goes through PgBouncer
+DATABASE_LISTEN_URL = os.environ.get('DATABASE_LISTEN_URL')
+
+
+'''
+ChangeListener class
+
+    Keeps a per-worker copy of the table versions, so a worker can tell that
+    a table changed without querying the database on every request.
+
+    - On Postgres a daemon thread holds a dedicated connection that LISTENs
+      on CHANGES_CHANNEL, and re-reads the versions when a NOTIFY arrives
+    - Behind PgBouncer, where a LISTEN does not survive the transaction,
+      the thread LISTENs on DATABASE_LISTEN_URL, a direct connection to the
+      same database, or without it polls the versions every
+      CHANGES_POLL_INTERVAL seconds instead; local_only is then True, the
+      row events of the other workers never reach this one
+    - Writes made by this worker record the committed version right away,
+      so the worker never serves its own stale data; a newer version the
+      listener already loaded is kept
+    - versions(names) returns a tuple of versions, or None while any of the
+      tables is unknown (listener starting or reconnecting)
+    - subscribe(callback) calls callback(name) for every changed table
+    - subscribe_rows(callback) calls callback(event) for every row event
+      received on ROW_CHANGES_CHANNEL, from any worker (LISTEN mode only,
+      listens tells which mode the worker runs in)
+'''
+
+class ChangeListener:
+    def __init__(self, poll_interval=CHANGES_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.notifications = 0
+        self._versions = None
+        self._callbacks = []
+        self._row_callbacks = []
+        self.listens = False
+        self.local_only = False
+        self._lock = threading.Lock()
+        self._pid = None
+        self._engine = None
+        change_hooks.append(self._forget)
+
+    def start(self, app):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._versions = None
+            with app.app_context():
+                self._engine = db.engine
+            listen_url = app.config.get('DATABASE_LISTEN_URL', DATABASE_LISTEN_URL)
+            if PGBOUNCER and listen_url:
+                self._engine = create_engine(listen_url, poolclass=NullPool)
+            postgres = self._engine.dialect.name == 'postgresql'
+            self.listens = postgres and (not PGBOUNCER or bool(listen_url))
+            self.local_only = postgres and not self.listens
+            target = self._listen_loop if self.listens else self._poll_loop
+            threading.Thread(target=target, daemon=True).start()
+
+    def subscribe(self, callback):
+        self._callbacks.append(callback)
+
+    def subscribe_rows(self, callback):
+        self._row_callbacks.append(callback)
+
+    def versions(self, names):
+        versions = self._versions
+        if versions is None:
+            return None
+        versions = tuple(versions.get(name, 0) for name in names)
+        if None in versions:
+            return None
+        return versions
+
+    def _forget(self, name, version):
+        # The listener may already have loaded this commit, or a later one
+        versions = self._versions
+        if versions is not None and (versions.get(name) or 0) < version:
+            self._versions = {**versions, name: version}
+        self._changed([name])
+
+    def _changed(self, names):
+        for name in names:
+            for callback in self._callbacks:
+                callback(name)
+
+    def _load(self, connection):
+        table = TableVersion.__table__
+        rows = connection.execute(db.select([table.c.name, table.c.version]))
+        versions = {name: version for name, version in rows}
+        old = self._versions or {}
+        self._versions = versions
+        changed = set(versions) | set(old)
+        self._changed([name for name in changed if old.get(name) != versions.get(name)])
+
+    def _poll_loop(self):
+        while True:
+            try:
+                with self._engine.connect() as connection:
+                    self._load(connection)
+            except Exception:
+                self._versions = None
+            time.sleep(self.poll_interval)
+
+    def _listen_loop(self):
+        while True:
+            raw = None
+            try:
+                raw = self._engine.raw_connection()
+                raw.detach()
+                connection = raw.connection
+                connection.autocommit = True
+                cursor = connection.cursor()
+                cursor.execute(f'LISTEN {CHANGES_CHANNEL}; LISTEN {ROW_CHANGES_CHANNEL}')
+                # Versions are read after LISTEN, so no change falls in between
+                self._load(self._engine)
+                while True:
+                    if select.select([connection], [], [], 60) == ([], [], []):
+                        continue
+                    connection.poll()
+                    if connection.notifies:
+                        notifies = connection.notifies[:]
+                        del connection.notifies[:]
+                        self.notifications += len(notifies)
+                        # Versions first, so a client reacting to a row event
+                        # never gets a cached listing from before the change
+                        if any(notify.channel == CHANGES_CHANNEL for notify in notifies):
+                            self._load(self._engine)
+                        for notify in notifies:
+                            if notify.channel == ROW_CHANGES_CHANNEL:
+                                event = json.loads(notify.payload)
+                                for callback in self._row_callbacks:
+                                    callback(event)
+            except Exception:
+                self._versions = None
+                if raw is not None:
+                    try:
+                        raw.close()
+                    except Exception:
+                        pass
+                time.sleep(self.poll_interval)
+
+
+change_listener = ChangeListener()
@@ -0,0 +1,102 @@
+import atexit, logging, os, threading, time
+from concurrent.futures import Future
+
+from models import Bot
+from metrics import COALESCE_QUEUE_DEPTH, COALESCE_FLUSH_SECONDS, COALESCE_FLUSH_ROWS
+
+# Opt-in, PATCH /bots/<id> setting only active goes through ActiveWrites
+WRITE_COALESCING = os.environ.get('WRITE_COALESCING', '0') == '1'
+# Seconds toggles are gathered before a flush
+COALESCE_INTERVAL = float(os.environ.get('COALESCE_INTERVAL', 0.01))
+# Bots pending that flush right away
+COALESCE_MAX_BATCH = int(os.environ.get('COALESCE_MAX_BATCH', 1000))
+# Seconds a caller waits for its flush
+COALESCE_TIMEOUT = float(os.environ.get('COALESCE_TIMEOUT', 5))
+
+logger = logging.getLogger('coalesce')
+
+
+'''
+ActiveWrites class
+
+    Coalesces the active toggles of the bots of one worker into group
+    commits
+
+    - submit(bot_id, active, subject) queues the toggle and returns a
+      Future, the last toggle of a bot before the flush wins, and its token
+      subject goes in the row event of the bot
+    - A background thread flushes the queue COALESCE_INTERVAL seconds after
+      the first toggle, or as soon as COALESCE_MAX_BATCH bots are pending,
+      with Bot.set_active: one UPDATE and one commit for the whole batch
+    - Every Future of a bot resolves after the commit with the row as it
+      was written, None when there is no such bot, or with the error of the
+      flush. Waiting on it is waiting for durability, not waiting is an
+      asynchronous acknowledgement
+    - flush() writes what is pending now, it also runs when the process exits
+    - Queue depth and flush time and size are Prometheus metrics
+'''
+
+class ActiveWrites:
+    def __init__(self, app, interval=COALESCE_INTERVAL, max_batch=COALESCE_MAX_BATCH):
+        self.app = app
+        self.interval = interval
+        self.max_batch = max_batch
+        self.flushes = 0
+        self._pending = {}
+        self._ready = threading.Condition()
+        self._thread = None
+        atexit.register(self.flush)
+
+    def submit(self, bot_id, active, subject=None):
+        future = Future()
+        with self._ready:
+            state = self._pending.setdefault(bot_id, [active, subject, []])
+            state[0], state[1] = active, subject
+            state[2].append(future)
+            COALESCE_QUEUE_DEPTH.set(len(self._pending))
+            self._start()
+            self._ready.notify()
+        return future
+
+    def _start(self):
+        # Threads do not survive a fork, each worker starts its own
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._ready:
+                self._ready.wait_for(lambda: self._pending)
+                self._ready.wait_for(lambda: len(self._pending) >= self.max_batch, self.interval)
+            self.flush()
+
+    def flush(self):
+        with self._ready:
+            pending, self._pending = self._pending, {}
+            COALESCE_QUEUE_DEPTH.set(0)
+        if not pending:
+            return 0
+
+        start = time.perf_counter()
+        try:
+            with self.app.app_context():
+                rows = Bot.set_active(
+                    {bot_id: active for bot_id, (active, _, _) in pending.items()},
+                    {bot_id: subject for bot_id, (_, subject, _) in pending.items()}
+                )
+        except Exception as e:
+            logger.exception('coalesced flush of %d bots failed', len(pending))
+            for _, _, futures in pending.values():
+                for future in futures:
+                    future.set_exception(e)
+            return 0
+        finally:
+            COALESCE_FLUSH_SECONDS.observe(time.perf_counter() - start)
+
+        self.flushes += 1
+        COALESCE_FLUSH_ROWS.observe(len(pending))
+        for bot_id, (_, _, futures) in pending.items():
+            for future in futures:
+                future.set_result(rows.get(bot_id))
+        return len(pending)
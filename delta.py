@@ -0,0 +1,134 @@
+import base64, json, os
+from datetime import datetime, timedelta, timezone
+from flask import abort, request
+
+from models import db, Tombstone
+from serializers import jsonify
+
+# Longest a write transaction may run between its start, when updated_at
+# is stamped, and its commit; rows are looked up this far before the token
+SYNC_OVERLAP = float(os.environ.get('SYNC_OVERLAP', 10))
+# Tombstones kept, older tokens have to resync from scratch
+SYNC_TOMBSTONE_DAYS = float(os.environ.get('SYNC_TOMBSTONE_DAYS', 30))
+
+
+'''
+encode_since(moment) and decode_since(token) methods
+
+    The sync token is an opaque url-safe token wrapping a database time
+    - '0' (or an empty token) stands for the beginning, a sync from scratch
+    - decode_since aborts with 400 when the token was not produced by encode_since
+'''
+
+def aware(moment):
+    # SQLite hands back naive UTC times
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def encode_since(moment):
+    if moment is None:
+        return '0'
+    data = json.dumps({'since': aware(moment).isoformat()}, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def decode_since(token):
+    if token in ('', '0'):
+        return None
+    try:
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        return aware(datetime.fromisoformat(json.loads(data)['since']))
+    except Exception:
+        abort(400)
+
+
+'''
+Delta class
+
+    Delta sync for the listing routes, driven by ?since=<token>
+
+    - Delta.from_request() reads the token, from_args(args) any mapping
+        + without since the delta is disabled and the listing is unchanged
+        + since cannot be combined with limit or cursor (400), and a token
+          older than SYNC_TOMBSTONE_DAYS is a 410, its tombstones are gone
+    - fetch(query, model, *related) returns the rows whose updated_at, or
+      the updated_at of a related row (relationships such as Bot.strategy),
+      is after the token, every row from scratch
+        + query is a column query (fields.py), each row comes back with the
+          time of the read as its last column
+        + the lookup starts SYNC_OVERLAP seconds before the token, since
+          updated_at is the start of the writing transaction and a slow
+          one commits later, so a client may get a row twice but never
+          misses one
+    - response(records, model) wraps the delta as
+      {'changed': [...], 'deleted': [ids], 'since': token}, the next token
+      being the database time of the read
+        + deleted lists the ids of the tombstones after the token whose row
+          does not exist anymore
+'''
+
+class Delta:
+    def __init__(self, since=None, enabled=False):
+        self.since = since
+        self.enabled = enabled
+        self.synced_at = since
+
+    @classmethod
+    def from_request(cls):
+        return cls.from_args(request.args)
+
+    @classmethod
+    def from_args(cls, args):
+        token = args.get('since')
+        if token is None:
+            return cls()
+        if args.get('limit') is not None or args.get('cursor') is not None:
+            abort(400)
+
+        since = decode_since(token)
+        oldest = datetime.now(timezone.utc) - timedelta(days=SYNC_TOMBSTONE_DAYS)
+        if since is not None and since < oldest:
+            abort(410)
+        return cls(since, True)
+
+    @property
+    def start(self):
+        return self.since - timedelta(seconds=SYNC_OVERLAP)
+
+    def observe(self, rows):
+        # The time of the read is the last column of every row
+        if rows:
+            synced_at = aware(rows[0][-1])
+            if self.synced_at is None or synced_at > self.synced_at:
+                self.synced_at = synced_at
+
+    def fetch(self, query, model, *related):
+        if self.since is not None:
+            query = query.filter(db.or_(
+                model.updated_at > self.start,
+                *(relation.has(relation.property.mapper.class_.updated_at > self.start)
+                  for relation in related)
+            ))
+        rows = query.add_columns(db.func.now().label('synced_at')).order_by(model.id).all()
+        self.observe(rows)
+        return rows
+
+    def deleted(self, model):
+        if self.since is None:
+            return []
+        rows = db.session.query(Tombstone.row_id, db.func.now().label('synced_at')) \
+            .outerjoin(model, model.id == Tombstone.row_id) \
+            .filter(Tombstone.table_name == model.__tablename__,
+                    Tombstone.deleted_at > self.start,
+                    model.id.is_(None)) \
+            .distinct().order_by(Tombstone.row_id).all()
+        self.observe(rows)
+        return [row_id for row_id, _ in rows]
+
+    def response(self, records, model):
+        deleted = self.deleted(model)
+        return jsonify({
+            'changed': records,
+            'deleted': deleted,
+            'since': encode_since(self.synced_at)
+        })
@@ -0,0 +1,49 @@
+import hashlib
+from functools import wraps
+from flask import make_response, request
+from models import table_versions
+
+
+'''
+listing_etag(tables) method
+
+    - Builds a strong ETag from the versions of the tables behind a listing
+    - The query string and the Accept header are part of the tag, since
+      pages, filters and NDJSON are different representations
+'''
+
+def listing_etag(tables):
+    variant = f'{request.full_path}|{request.headers.get("Accept", "")}'
+    return make_etag(table_versions(tables), tables, variant)
+
+
+def make_etag(versions, tables, variant):
+    tag = '-'.join(f'{name}.{versions[name]}' for name in tables)
+    return tag + '-' + hashlib.sha1(variant.encode()).hexdigest()[:16]
+
+
+'''
+@versioned(*tables) decorator method
+
+    Required inputs:
+        tables: names of the tables the listing reads ('bot', 'strategy')
+
+    - Answers If-None-Match with a 304 when the ETag still matches, without
+      running the listing query
+    - Otherwise runs the route and sets the ETag on its response
+    - Goes below @requires_auth, so only authorized clients get a 304
+'''
+
+def versioned(*tables):
+    def versioned_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            etag = listing_etag(tables)
+            if request.if_none_match.contains(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+            response.set_etag(etag)
+            return response
+        return wrapper
+    return versioned_decorator
@@ -0,0 +1,130 @@
+import os, threading, time
+from collections import deque
+from queue import Queue, Empty
+from flask import Response, stream_with_context
+
+from changes import change_listener
+from models import row_hooks
+from serializers import dumps
+
+CHANGE_REPLAY_SIZE = int(os.environ.get('CHANGE_REPLAY_SIZE', 10000))
+CHANGE_QUEUE_SIZE = int(os.environ.get('CHANGE_QUEUE_SIZE', 1000))
+SSE_HEARTBEAT = float(os.environ.get('SSE_HEARTBEAT', 15))
+EVENT_STREAM = 'text/event-stream'
+
+
+'''
+ChangeFeed class
+
+    Per-worker fan-out of row events to the open change streams
+
+    - publish(event) expands one row event of commit_changes into one change
+      per row, {'id', 'table', 'op', 'row'} with id '<table>.<version>.<n>',
+      the same on every worker, and hands them to every subscriber
+    - The last CHANGE_REPLAY_SIZE changes are kept for resuming
+    - subscribe(last_id) returns (queue, backlog): the changes after last_id
+      still in the buffer, or None when last_id is no longer in it (the
+      client has to resync). The queue then receives lists of changes, and
+      None when the subscriber fell more than CHANGE_QUEUE_SIZE batches
+      behind and was dropped
+    - Events arrive through LISTEN/NOTIFY from every worker, or straight from
+      this worker's commits when the change listener does not listen; behind
+      PgBouncer without DATABASE_LISTEN_URL that would hide the commits of
+      the other workers, so the stream route answers 503 there
+'''
+
+class ChangeFeed:
+    def __init__(self, size=CHANGE_REPLAY_SIZE, queue_size=CHANGE_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.published = 0
+        self._changes = deque(maxlen=size)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def publish(self, event):
+        table, version, op = event['table'], event['version'], event['op']
+        ids = event['ids'] if event['ids'] is not None else [None]
+        changes = [
+            {'id': f'{table}.{version}.{event["start"] + i}', 'table': table, 'op': op, 'row': row_id}
+            for i, row_id in enumerate(ids)
+        ]
+        with self._lock:
+            self._changes.extend(changes)
+            self.published += len(changes)
+            for queue in list(self._subscribers):
+                if queue.qsize() >= self.queue_size:
+                    self._subscribers.discard(queue)
+                    queue.put(None)
+                else:
+                    queue.put(changes)
+
+    def subscribe(self, last_id=None):
+        queue = Queue()
+        with self._lock:
+            self._subscribers.add(queue)
+            if last_id is None:
+                return queue, []
+            changes = list(self._changes)
+        for i in range(len(changes) - 1, -1, -1):
+            if changes[i]['id'] == last_id:
+                return queue, changes[i + 1:]
+        return queue, None
+
+    def unsubscribe(self, queue):
+        with self._lock:
+            self._subscribers.discard(queue)
+
+    def local_commit(self, event):
+        if not change_listener.listens:
+            self.publish(event)
+
+
+change_feed = ChangeFeed()
+change_listener.subscribe_rows(change_feed.publish)
+row_hooks.append(change_feed.local_commit)
+
+
+'''
+stream_changes(last_id, expires_at) method
+
+    - Streams the feed as Server-Sent Events, one 'change' event per row,
+      resuming after last_id (Last-Event-ID)
+    - A 'reset' event means last_id is no longer in the replay buffer, or
+      the client fell behind, and the client should reload before going on
+    - Comments keep idle connections open every SSE_HEARTBEAT seconds
+    - The stream ends when the token expires at expires_at, the client
+      reconnects with a fresh one
+    - Returns a text/event-stream Response
+'''
+
+def sse(change):
+    return f'id: {change["id"]}\nevent: change\ndata: {dumps(change).decode()}\n\n'
+
+
+def stream_changes(last_id=None, expires_at=None, feed=change_feed):
+    queue, backlog = feed.subscribe(last_id)
+
+    def generate():
+        try:
+            yield 'retry: 2000\n\n'
+            if backlog is None:
+                yield 'event: reset\ndata: {}\n\n'
+            elif backlog:
+                yield ''.join(map(sse, backlog))
+            while expires_at is None or time.time() < expires_at:
+                try:
+                    changes = queue.get(timeout=SSE_HEARTBEAT)
+                except Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                if changes is None:
+                    yield 'event: reset\ndata: {}\n\n'
+                    return
+                yield ''.join(map(sse, changes))
+        finally:
+            feed.unsubscribe(queue)
+
+    return Response(stream_with_context(generate()), mimetype=EVENT_STREAM, headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
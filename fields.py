@@ -0,0 +1,87 @@
+from flask import abort, request
+from models import db, Strategy, Bot
+
+
+'''
+Fieldset class
+
+    Sparse fieldsets for a listing, driven by ?fields=id,name,active
+
+    - from_request() returns the requested field names, or None when the
+      parameter is absent; unknown fields are a 400
+    - query(names) selects only those columns, plus id for keyset
+      pagination, as plain row tuples so no ORM entity is built
+    - serializer(names) returns the function building one record from a row,
+      column values (ARRAY lists included) are used as they are
+    - select() returns (query, serializer) for the requested fields, every
+      field without ?fields=; the listing routes read through it
+'''
+
+class Fieldset:
+    def __init__(self, entity, columns, joins=()):
+        self.entity = entity
+        self.columns = columns
+        self.joins = joins
+
+    def from_request(self):
+        fields = request.args.get('fields')
+        if fields is None:
+            return None
+
+        names = []
+        for name in fields.split(','):
+            name = name.strip()
+            if name not in self.columns:
+                abort(400)
+            if name not in names:
+                names.append(name)
+        return names
+
+    def query(self, names):
+        columns = [self.columns[name].label(name) for name in names]
+        if 'id' not in names:
+            columns.append(self.entity.id.label('id'))
+
+        query = db.session.query(*columns).select_from(self.entity)
+        for target, condition in self.joins:
+            query = query.outerjoin(target, condition)
+        return query
+
+    def select(self):
+        names = self.from_request() or list(self.columns)
+        return self.query(names), self.serializer(names)
+
+    def serializer(self, names):
+        # Requested columns come first in the row, in the requested order
+        def serialize(row):
+            return dict(zip(names, row))
+        return serialize
+
+
+STRATEGY_FIELDS = Fieldset(Strategy, {
+    'id': Strategy.id,
+    'name': Strategy.name,
+})
+
+STRATEGY_DETAIL_FIELDS = Fieldset(Strategy, {
+    'id': Strategy.id,
+    'name': Strategy.name,
+    'params': Strategy.params,
+})
+
+BOT_FIELDS = Fieldset(Bot, {
+    'id': Bot.id,
+    'name': Bot.name,
+    'active': Bot.active,
+})
+
+BOT_DETAIL_FIELDS = Fieldset(Bot, {
+    'id': Bot.id,
+    'name': Bot.name,
+    'active': Bot.active,
+    'strategy': Strategy.name,
+    'strategy_id': Bot.strategy_id,
+    'timeframe': Bot.timeframe,
+    'params': Strategy.params,
+    'param_values': Bot.param_values,
+}, joins=[(Strategy, Strategy.id == Bot.strategy_id)])
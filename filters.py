@@ -0,0 +1,111 @@
+import operator, re
+from flask import abort, request
+from models import db, Bot, BotParam
+
+PREDICATE = re.compile(r'^\s*(\w+)\s*(<=|>=|!=|<|>|=)\s*(.+?)\s*$')
+OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '=': operator.eq,
+    '!=': operator.ne
+}
+
+
+'''
+bot_filters(args=None) method
+
+    Translates query string filters into SQL clauses on the bot table
+        ids: comma separated bot ids (?ids=1,2,3)
+        strategy_id: integer (?strategy_id=3)
+        timeframe: string (?timeframe=1h)
+        active: true or false (?active=true)
+
+    - Aborts with 400 when a value cannot be parsed
+    - Returns the list of clauses, empty when no filter was given
+    - parse_bot_filters(args) returns the parsed values by name instead,
+      for callers building their own SQL (ASGI mode)
+'''
+
+def _parse_bool(value):
+    if value.lower() in ('true', '1'):
+        return True
+    if value.lower() in ('false', '0'):
+        return False
+    abort(400)
+
+
+def parse_bot_filters(args):
+    filters = {}
+
+    try:
+        if args.get('ids'):
+            filters['ids'] = [int(bot_id) for bot_id in args.get('ids').split(',')]
+
+        if args.get('strategy_id') is not None:
+            filters['strategy_id'] = int(args.get('strategy_id'))
+    except ValueError:
+        abort(400)
+
+    if args.get('timeframe') is not None:
+        filters['timeframe'] = args.get('timeframe')
+
+    if args.get('active') is not None:
+        filters['active'] = _parse_bool(args.get('active'))
+
+    return filters
+
+
+def bot_filters(args=None):
+    filters = parse_bot_filters(request.args if args is None else args)
+    clauses = []
+
+    if 'ids' in filters:
+        clauses.append(Bot.id.in_(filters['ids']))
+
+    if 'strategy_id' in filters:
+        clauses.append(Bot.strategy_id == filters['strategy_id'])
+
+    if 'timeframe' in filters:
+        clauses.append(Bot.timeframe == filters['timeframe'])
+
+    if 'active' in filters:
+        clauses.append(Bot.active == filters['active'])
+
+    return clauses
+
+
+'''
+param_filters(args=None) method
+
+    Translates ?where= parameter predicates into SQL clauses on the bot table
+        where: '<name><op><value>', op one of < <= > >= = !=
+               (?where=stop_loss<0.02&where=window>=10)
+
+    - Numeric values are compared with the typed num_value of bot_param,
+      other values with the text value, both through (name, value) indexes
+    - Aborts with 400 on a malformed predicate
+    - Returns the list of clauses, one per predicate
+'''
+
+def param_filters(args=None):
+    args = request.args if args is None else args
+    clauses = []
+
+    for predicate in args.getlist('where'):
+        match = PREDICATE.match(predicate)
+        if match is None:
+            abort(400)
+        name, op, value = match.groups()
+
+        try:
+            column, value = BotParam.num_value, float(value)
+        except ValueError:
+            column = BotParam.value
+
+        matching = db.session.query(BotParam.bot_id) \
+            .filter(BotParam.name == name, OPERATORS[op](column, value))
+        clauses.append(Bot.id.in_(matching))
+
+    return clauses
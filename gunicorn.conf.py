@@ -0,0 +1,52 @@
+import glob, os, time
+
+'''
+Gunicorn settings, read automatically by `gunicorn app:app`
+
+    - PRELOAD_APP=1 imports the app once in the master and forks workers
+      from it, nothing touches the database before the fork
+    - Every worker runs warm_up before it accepts traffic and logs its
+      cold start: time from fork to app loaded, and each warm-up step
+    - WARMUP=0 skips the warm-up
+    - Workers are threaded (gthread) with GUNICORN_THREADS threads (100),
+      since every open /bots/changes stream holds a thread while it lasts;
+      -k on the command line still wins, e.g. for the Uvicorn workers
+    - With prometheus_multiproc_dir set, the metrics files of a previous
+      run are removed on start and those of a dead worker on its exit
+'''
+
+preload_app = os.environ.get('PRELOAD_APP', '0') == '1'
+warmup = os.environ.get('WARMUP', '1') == '1'
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 100))
+
+multiproc_dir = os.environ.get('prometheus_multiproc_dir')
+
+
+def on_starting(server):
+    if multiproc_dir:
+        for path in glob.glob(os.path.join(multiproc_dir, '*.db')):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    if multiproc_dir:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+
+
+def post_worker_init(worker):
+    loaded = time.perf_counter()
+    timings = {}
+    if warmup:
+        from app import app
+        from warmup import warm_up
+        timings = warm_up(app)
+    ready = time.perf_counter()
+    worker.log.info(
+        'worker %s cold start %.1f ms (load %.1f ms, warm-up %s)', worker.pid,
+        (ready - worker.forked_at) * 1e3, (loaded - worker.forked_at) * 1e3, timings)
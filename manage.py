@@ -1,8 +1,12 @@
-from flask_script import Manager
+import sys
+from datetime import datetime, timedelta, timezone
+from flask_script import Manager, Command, Option
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models import db
+from models import db, prune_tombstones
+from delta import SYNC_TOMBSTONE_DAYS
+from transfer import TRANSFER_TABLES, copy_out, copy_in, export_parquet, import_parquet
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +14,62 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+'''
+Table transfer commands
+    python manage.py export bot bots.csv   (- for stdout, .parquet for Parquet)
+    python manage.py import bot bots.csv   (- for stdin, upserts by id)
+    Import strategies before the bots that reference them.
+'''
+
+class ExportCommand(Command):
+    option_list = (Option('table', choices=sorted(TRANSFER_TABLES)), Option('path'))
+
+    def run(self, table, path):
+        model = TRANSFER_TABLES[table]
+        connection = db.engine.raw_connection()
+        try:
+            if path.endswith('.parquet'):
+                export_parquet(connection, model, path)
+            elif path == '-':
+                copy_out(connection, model, sys.stdout.buffer)
+            else:
+                with open(path, 'wb') as f:
+                    copy_out(connection, model, f)
+        finally:
+            connection.close()
+
+
+class ImportCommand(Command):
+    option_list = (Option('table', choices=sorted(TRANSFER_TABLES)), Option('path'))
+
+    def run(self, table, path):
+        model = TRANSFER_TABLES[table]
+        if path.endswith('.parquet'):
+            count = import_parquet(model, path)
+        elif path == '-':
+            count = copy_in(model, sys.stdin.buffer)
+        else:
+            with open(path, 'rb') as f:
+                count = copy_in(model, f)
+        print(f'{count} {table} rows imported')
+
+
+'''
+Tombstone pruning
+    python manage.py prune_tombstones   (older than SYNC_TOMBSTONE_DAYS)
+    Sync tokens older than that get a 410 and sync again from scratch.
+'''
+
+class PruneTombstonesCommand(Command):
+    def run(self):
+        before = datetime.now(timezone.utc) - timedelta(days=SYNC_TOMBSTONE_DAYS)
+        print(f'{prune_tombstones(before)} tombstones pruned')
+
+
+manager.add_command('export', ExportCommand())
+manager.add_command('import', ImportCommand())
+manager.add_command('prune_tombstones', PruneTombstonesCommand())
+
+
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    manager.run()
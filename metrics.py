@@ -0,0 +1,119 @@
+import os, time
+from flask import Response, g, has_request_context, request
+from prometheus_client import (CollectorRegistry, CONTENT_TYPE_LATEST, REGISTRY,
+                               Counter, Gauge, Histogram, generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Set to an empty directory shared by the gunicorn workers to aggregate them
+MULTIPROC_DIR = os.environ.get('prometheus_multiproc_dir')
+
+SQL_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, 250)
+
+
+'''
+Metrics
+
+    Prometheus metrics of the worker, served at /metrics
+    - http_request_duration_seconds: latency histogram per route and method
+    - http_requests_total: responses per route, method and status code
+    - sql_statements_per_request, sql_seconds_per_request: number and total
+      time of the SQL statements run by one request, from engine events
+    - jwt_verify_seconds: time spent in verify_decode_jwt (JWKS lookup and
+      RS256 verification, cache hits excluded)
+    - db_pool_*: connection pool state and checkout wait time, per bind
+      (primary, replica)
+    - write_coalescing_*: bots waiting for the next coalesced flush, and
+      the time and size of the flushes (see coalesce.py)
+    - db_replica_lag_seconds, db_reads_total: replication lag of the read
+      replica and GET requests by the database they read from (replica.py)
+
+    With prometheus_multiproc_dir set, every worker writes its samples to
+    that directory and /metrics aggregates all of them, whichever worker
+    answers (gunicorn.conf.py clears it on start and on worker exit)
+'''
+
+REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Request latency', ['endpoint', 'method'])
+REQUESTS = Counter(
+    'http_requests_total', 'Responses by status code', ['endpoint', 'method', 'status'])
+SQL_STATEMENTS = Histogram(
+    'sql_statements_per_request', 'SQL statements run by one request', ['endpoint'],
+    buckets=SQL_COUNT_BUCKETS)
+SQL_SECONDS = Histogram(
+    'sql_seconds_per_request', 'Time spent in SQL statements by one request', ['endpoint'])
+JWT_VERIFY_SECONDS = Histogram(
+    'jwt_verify_seconds', 'Time spent in verify_decode_jwt')
+
+POOL_WAIT_SECONDS = Histogram(
+    'db_pool_wait_seconds', 'Time spent getting a connection out of the pool', ['bind'])
+POOL_TIMEOUTS = Counter(
+    'db_pool_timeouts_total', 'Pool checkouts that timed out', ['bind'])
+POOL_CHECKED_OUT = Gauge(
+    'db_pool_checked_out', 'Connections checked out', ['bind'], multiprocess_mode='livesum')
+POOL_OVERFLOW = Gauge(
+    'db_pool_overflow', 'Connections open beyond the pool size', ['bind'],
+    multiprocess_mode='livesum')
+
+COALESCE_QUEUE_DEPTH = Gauge(
+    'write_coalescing_queue_depth', 'Bots waiting for the next coalesced flush',
+    multiprocess_mode='livesum')
+COALESCE_FLUSH_SECONDS = Histogram(
+    'write_coalescing_flush_seconds', 'Time of one coalesced flush, UPDATE and commit')
+COALESCE_FLUSH_ROWS = Histogram(
+    'write_coalescing_flush_rows', 'Bots written by one coalesced flush',
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+REPLICA_LAG_SECONDS = Gauge(
+    'db_replica_lag_seconds', 'Replication lag of the read replica', multiprocess_mode='max')
+REPLICA_READS = Counter(
+    'db_reads_total', 'GET requests by the database they read from', ['target'])
+
+
+def endpoint_label():
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.sql_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_started' in g:
+        g.sql_statements = g.get('sql_statements', 0) + 1
+        g.sql_seconds = g.get('sql_seconds', 0.0) + time.perf_counter() - g.pop('sql_started')
+
+
+'''
+init_metrics(app)
+    records the request metrics of the app and adds the /metrics route
+'''
+
+def init_metrics(app):
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        if 'request_started' not in g:
+            return response
+        endpoint, method = endpoint_label(), request.method
+        REQUEST_SECONDS.labels(endpoint, method).observe(
+            time.perf_counter() - g.request_started)
+        REQUESTS.labels(endpoint, method, response.status_code).inc()
+        SQL_STATEMENTS.labels(endpoint).observe(g.get('sql_statements', 0))
+        SQL_SECONDS.labels(endpoint).observe(g.get('sql_seconds', 0.0))
+        return response
+
+    @app.route('/metrics')
+    def get_metrics():
+        registry = REGISTRY
+        if MULTIPROC_DIR:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
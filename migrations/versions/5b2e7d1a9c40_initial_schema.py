@@ -0,0 +1,40 @@
+"""initial schema
+
+Revision ID: 5b2e7d1a9c40
+Revises: 
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '5b2e7d1a9c40'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('strategy',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=50), nullable=True),
+    sa.Column('params', postgresql.ARRAY(sa.String()), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('bot',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=20), nullable=True),
+    sa.Column('active', sa.Boolean(), nullable=True),
+    sa.Column('timeframe', sa.String(length=5), nullable=True),
+    sa.Column('param_values', postgresql.ARRAY(sa.String()), nullable=True),
+    sa.Column('strategy_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['strategy_id'], ['strategy.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('bot')
+    op.drop_table('strategy')
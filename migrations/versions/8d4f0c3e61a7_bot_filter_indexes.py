@@ -0,0 +1,29 @@
+"""bot filter indexes
+
+Revision ID: 8d4f0c3e61a7
+Revises: 3f6c8a1d2b57
+Create Date: 2026-10-17 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d4f0c3e61a7'
+down_revision = '3f6c8a1d2b57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_bot_strategy_id_timeframe', 'bot', ['strategy_id', 'timeframe'], unique=False)
+    op.create_index('ix_bot_timeframe', 'bot', ['timeframe'], unique=False)
+    # Partial index on active bots, in id order for keyset pagination
+    op.create_index('ix_bot_active', 'bot', ['id'], unique=False, postgresql_where=sa.text('active'))
+
+
+def downgrade():
+    op.drop_index('ix_bot_active', table_name='bot')
+    op.drop_index('ix_bot_timeframe', table_name='bot')
+    op.drop_index('ix_bot_strategy_id_timeframe', table_name='bot')
@@ -0,0 +1,49 @@
+"""typed bot params
+
+Revision ID: c17a5e2b8f93
+Revises: 8d4f0c3e61a7
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c17a5e2b8f93'
+down_revision = '8d4f0c3e61a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('bot_param',
+    sa.Column('bot_id', sa.Integer(), nullable=False),
+    sa.Column('position', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('value', sa.String(), nullable=True),
+    sa.Column('num_value', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['bot_id'], ['bot.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('bot_id', 'position')
+    )
+    op.create_index('ix_bot_param_name_num_value', 'bot_param', ['name', 'num_value'], unique=False)
+    op.create_index('ix_bot_param_name_value', 'bot_param', ['name', 'value'], unique=False)
+
+    # Backfill from the existing parameter arrays
+    op.execute(r'''
+    INSERT INTO bot_param (bot_id, position, name, value, num_value)
+    SELECT bot.id, u.position, u.name, u.value,
+      CASE WHEN u.value ~ '^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$'
+        THEN u.value::double precision END
+    FROM bot
+    JOIN strategy ON strategy.id = bot.strategy_id
+    CROSS JOIN LATERAL unnest(strategy.params, bot.param_values)
+      WITH ORDINALITY AS u(name, value, position)
+    WHERE u.name IS NOT NULL
+    ''')
+
+
+def downgrade():
+    op.drop_index('ix_bot_param_name_value', table_name='bot_param')
+    op.drop_index('ix_bot_param_name_num_value', table_name='bot_param')
+    op.drop_table('bot_param')
@@ -0,0 +1,42 @@
+"""delta sync
+
+Revision ID: e4a9d6b3f215
+Revises: c17a5e2b8f93
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a9d6b3f215'
+down_revision = 'c17a5e2b8f93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing rows are stamped with the time of the upgrade
+    for table in ('strategy', 'bot'):
+        op.add_column(table, sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False))
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False))
+        op.create_index(f'ix_{table}_updated_at', table, ['updated_at'], unique=False)
+
+    op.create_table('tombstone',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('table_name', sa.String(length=50), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=False),
+    sa.Column('deleted_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_tombstone_table_name_deleted_at', 'tombstone', ['table_name', 'deleted_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_tombstone_table_name_deleted_at', table_name='tombstone')
+    op.drop_table('tombstone')
+    for table in ('bot', 'strategy'):
+        op.drop_index(f'ix_{table}_updated_at', table_name=table)
+        op.drop_column(table, 'updated_at')
+        op.drop_column(table, 'created_at')
@@ -1,24 +1,226 @@
 from sqlalchemy import create_engine
-from flask_sqlalchemy import SQLAlchemy
 import json, os
 from sqlalchemy.dialects import postgresql
+from pool import engine_options
+from replica import RoutingSQLAlchemy, REPLICA_BIND, current_subject
 
 # from app import app
 
 database_path = os.environ['DATABASE_URL']
+database_replica_path = os.environ.get('DATABASE_REPLICA_URL')
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    - does not touch the database, the schema is managed by the
+      migrations (python manage.py db upgrade)
+    - pool settings come from the DB_POOL_* variables (see pool.py),
+      SQLALCHEMY_ENGINE_OPTIONS set on the app overrides them
+    - with a replica path (DATABASE_REPLICA_URL), GET requests read from
+      that bind (see replica.py), a replica bind set on the app wins
 '''
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, replica_path=database_replica_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    if replica_path:
+        app.config["SQLALCHEMY_BINDS"] = {
+            REPLICA_BIND: replica_path,
+            **(app.config.get("SQLALCHEMY_BINDS") or {})
+        }
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        **engine_options(database_path),
+        **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+    }
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+
+'''
+Table versions
+    Every write through the model methods bumps a per-table version in the
+    same transaction, the listing routes expose it as an ETag
+    - bump_version(name) increments the version of one table, returns it
+    - commit_changes(name, op, ids) bumps the version, sends a NOTIFY on the
+      CHANGES_CHANNEL (Postgres) and commits, then runs the change_hooks
+      with the table name and its new version
+    - with op ('insert', 'update', 'delete' or 'import') it also describes
+      the changed rows in row events (see change_events), sent on the
+      ROW_CHANGES_CHANNEL in the same transaction and to the row_hooks after
+      the commit
+    - a 'delete' also leaves one tombstone per deleted id (see Tombstone)
+    - table_versions(names) reads the versions in one query, 0 when unset
+'''
+CHANGES_CHANNEL = 'table_changes'
+ROW_CHANGES_CHANNEL = 'row_changes'
+# Ids per row event, keeps a NOTIFY payload under the 8000 bytes limit
+ROW_EVENT_IDS = 500
+change_hooks = []
+row_hooks = []
+
+def bump_version(name):
+  table = TableVersion.__table__
+  if db.session.get_bind().dialect.name == 'postgresql':
+    # One upsert, so two first writes to a table cannot both insert its row
+    statement = postgresql.insert(table).values(name=name, version=1)
+    statement = statement.on_conflict_do_update(
+      index_elements=[table.c.name], set_={'version': table.c.version + 1})
+    return db.session.execute(statement.returning(table.c.version)).scalar()
+
+  # SQLite, a single writer at a time
+  db.session.execute(table.update().where(table.c.name == name)
+    .values(version=table.c.version + 1))
+  version = db.session.query(TableVersion.version).filter(TableVersion.name == name).scalar()
+  if version is None:
+    version = 1
+    db.session.execute(table.insert().values(name=name, version=version))
+  return version
+
+'''
+change_events(name, version, op, ids, subject, subjects)
+    row events of one write, {'table', 'version', 'op', 'start', 'ids',
+    'subject'} with at most ROW_EVENT_IDS ids each, start being the position
+    of the first id in the write. ids None (import) gives one event with no
+    ids, an empty list gives no event. subject is the token subject of the
+    request that wrote, if any, so every worker sends its reads to the
+    primary for a while (see replica.py). subjects maps ids to their own
+    subject, for writes gathered from several requests (see coalesce.py),
+    the ids of one subject then share events
+'''
+def change_events(name, version, op, ids, subject=None, subjects=None):
+  if ids is None:
+    return [{'table': name, 'version': version, 'op': op, 'start': 0, 'ids': None,
+             'subject': subject}]
+  groups = {}
+  for row_id in ids:
+    groups.setdefault(subjects.get(row_id, subject) if subjects else subject, []).append(row_id)
+  events, start = [], 0
+  for group_subject, group_ids in groups.items():
+    for offset in range(0, len(group_ids), ROW_EVENT_IDS):
+      events.append({'table': name, 'version': version, 'op': op, 'start': start + offset,
+                     'ids': group_ids[offset:offset + ROW_EVENT_IDS], 'subject': group_subject})
+    start += len(group_ids)
+  return events
+
+def commit_changes(name, op=None, ids=None, subjects=None):
+  version = bump_version(name)
+  events = change_events(name, version, op, ids, current_subject(), subjects) if op else []
+  if db.session.get_bind().dialect.name == 'postgresql':
+    # Delivered to every LISTEN-ing worker when the transaction commits,
+    # in commit order, all notifications in one statement
+    payloads = [(CHANGES_CHANNEL, name)] + \
+      [(ROW_CHANGES_CHANNEL, json.dumps(event)) for event in events]
+    calls = ', '.join(f'pg_notify(:channel_{i}, :payload_{i})' for i in range(len(payloads)))
+    params = {}
+    for i, (channel, payload) in enumerate(payloads):
+      params[f'channel_{i}'], params[f'payload_{i}'] = channel, payload
+    db.session.execute(db.text(f'SELECT {calls}'), params)
+  if op == 'delete' and ids:
+    db.session.execute(Tombstone.__table__.insert(),
+      [{'table_name': name, 'row_id': row_id} for row_id in ids])
+  db.session.commit()
+  for hook in change_hooks:
+    hook(name, version)
+  for event in events:
+    for hook in row_hooks:
+      hook(event)
+
+def table_versions(names):
+  versions = dict.fromkeys(names, 0)
+  rows = db.session.query(TableVersion.name, TableVersion.version) \
+    .filter(TableVersion.name.in_(names))
+  versions.update(rows)
+  return versions
+
+
+'''
+bulk_insert(table, rows)
+    inserts many rows in the current transaction and returns their ids
+    - rows carrying an id go through one executemany(), then the id
+      sequence is moved past them (Postgres) so generated ids never collide
+    - rows without one go through a multi-row INSERT ... RETURNING id
+    - the caller commits
+'''
+BULK_CHUNK_SIZE = 1000
+
+def bulk_insert(table, rows):
+  ids = [row.get('id') for row in rows]
+  with_id = [row for row in rows if row.get('id') is not None]
+  without_id = [i for i, row in enumerate(rows) if row.get('id') is None]
+
+  if with_id:
+    db.session.execute(table.insert(), with_id)
+    if db.session.get_bind().dialect.name == 'postgresql':
+      # Only ever forward, a concurrent insert may hold a higher generated id
+      db.session.execute(db.text(
+        f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+        f"GREATEST(:max_id, nextval(pg_get_serial_sequence('{table.name}', 'id'))))"),
+        {'max_id': max(row['id'] for row in with_id)})
+
+  for start in range(0, len(without_id), BULK_CHUNK_SIZE):
+    chunk = without_id[start:start + BULK_CHUNK_SIZE]
+    values = [{k: v for k, v in rows[i].items() if k != 'id'} for i in chunk]
+    result = db.session.execute(table.insert().values(values).returning(table.c.id))
+    for i, (new_id,) in zip(chunk, result):
+      ids[i] = new_id
+
+  return ids
+
+
+'''
+update_where(table, clauses, values) and delete_where(table, clauses)
+    run one UPDATE / DELETE ... RETURNING id over the rows matching clauses
+    and return the affected ids, the caller commits
+update_one(table, row_id, values)
+    runs one UPDATE ... RETURNING on the row with that id and returns the
+    updated row, or None when there is no such row
+'''
+def update_where(table, clauses, values):
+  statement = table.update().where(db.and_(*clauses)).values(**values)
+  return [row_id for (row_id,) in db.session.execute(statement.returning(table.c.id))]
+
+def update_one(table, row_id, values):
+  statement = table.update().where(table.c.id == row_id).values(**values)
+  return db.session.execute(statement.returning(*table.c)).first()
+
+def delete_where(table, clauses):
+  statement = table.delete().where(db.and_(*clauses))
+  return [row_id for (row_id,) in db.session.execute(statement.returning(table.c.id))]
+
+
+'''
+sync_bot_params(ids=None, strategy_id=None, where=None)
+    rebuilds the typed bot_param rows of the given bots, of every bot of
+    a strategy, or of the bots matching a SQL condition on bot, from
+    strategy.params (names) and bot.param_values (values)
+    - num_value holds the value as a number when it parses as one, so range
+      predicates use the (name, num_value) index
+    - runs in the current transaction, the caller commits
+'''
+SYNC_BOT_PARAMS = r'''
+INSERT INTO bot_param (bot_id, position, name, value, num_value)
+SELECT bot.id, u.position, u.name, u.value,
+  CASE WHEN u.value ~ '^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$'
+    THEN u.value::double precision END
+FROM bot
+JOIN strategy ON strategy.id = bot.strategy_id
+CROSS JOIN LATERAL unnest(strategy.params, bot.param_values)
+  WITH ORDINALITY AS u(name, value, position)
+WHERE u.name IS NOT NULL AND {where}
+'''
+
+def sync_bot_params(ids=None, strategy_id=None, where=None):
+  if where is not None:
+    params = {}
+  elif ids is not None:
+    where, params = 'bot.id = ANY(:ids)', {'ids': list(ids)}
+  else:
+    where, params = 'bot.strategy_id = :strategy_id', {'strategy_id': strategy_id}
+
+  db.session.execute(db.text(
+    f'DELETE FROM bot_param USING bot WHERE bot_param.bot_id = bot.id AND {where}'), params)
+  db.session.execute(db.text(SYNC_BOT_PARAMS.format(where=where)), params)
 
 
 '''
@@ -26,35 +228,108 @@ Models
 Define the models used in the project
 '''
 
+class TableVersion(db.Model):
+  __tablename__ = 'table_version'
+
+  name = db.Column(db.String(50), primary_key=True)
+  version = db.Column(db.BigInteger, nullable=False, default=0)
+
+'''
+Tombstone
+    one row per deleted row, so delta syncs (?since=) report deletions
+    - written by commit_changes in the transaction of the delete
+    - kept SYNC_TOMBSTONE_DAYS (see delta.py), prune_tombstones drops older ones
+'''
+class Tombstone(db.Model):
+  __tablename__ = 'tombstone'
+  __table_args__ = (
+    db.Index('ix_tombstone_table_name_deleted_at', 'table_name', 'deleted_at'),
+  )
+
+  id = db.Column(db.Integer, primary_key=True)
+  table_name = db.Column(db.String(50), nullable=False)
+  row_id = db.Column(db.Integer, nullable=False)
+  deleted_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+
+def prune_tombstones(before):
+  count = Tombstone.query.filter(Tombstone.deleted_at < before).delete(synchronize_session=False)
+  db.session.commit()
+  return count
+
+'''
+Row timestamps
+    created_at and updated_at are set by the database, updated_at again on
+    every UPDATE issued through SQLAlchemy (ORM flushes, update_where,
+    update_one); raw SQL writes set it themselves (see transfer.py)
+'''
+def created_at_column():
+  return db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+
+def updated_at_column():
+  return db.Column(db.DateTime(timezone=True), nullable=False, index=True,
+    server_default=db.func.now(), onupdate=db.func.now())
+
 class Strategy(db.Model):
   __tablename__ = 'strategy'
 
   id = db.Column(db.Integer, primary_key=True)
   name = db.Column(db.String(50))
   params = db.Column(postgresql.ARRAY(db.String))
-  bots = db.relationship('Bot', backref = 'strategy', lazy = True)
+  created_at = created_at_column()
+  updated_at = updated_at_column()
+  bots = db.relationship('Bot', backref = db.backref('strategy', lazy = 'joined'), lazy = True)
 
   def format(self):
-    listy = [x for x in self.params]
     return {
       'id': self.id,
       'name': self.name,
-      'params': listy 
+      'params': self.params
     }
 
   def insert(self):
     db.session.add(self)
-    db.session.commit()
+    db.session.flush()
+    commit_changes(self.__tablename__, 'insert', [self.id])
+
+  @classmethod
+  def bulk_insert(cls, rows):
+    ids = bulk_insert(cls.__table__, rows)
+    commit_changes(cls.__tablename__, 'insert', ids)
+    return ids
 
   def delete(self):
     db.session.delete(self)
-    db.session.commit()
+    commit_changes(self.__tablename__, 'delete', [self.id])
 
   def update(self):
-    db.session.commit()
+    db.session.flush()
+    sync_bot_params(strategy_id=self.id)
+    commit_changes(self.__tablename__, 'update', [self.id])
+
+  @classmethod
+  def update_by_id(cls, row_id, values):
+    if not values:
+      return db.session.query(*cls.__table__.c).filter(cls.id == row_id).first()
+    row = update_one(cls.__table__, row_id, values)
+    if row is None:
+      # Nothing changed, the version and the caches stay as they are
+      db.session.rollback()
+      return None
+    if 'params' in values:
+      sync_bot_params(strategy_id=row_id)
+    commit_changes(cls.__tablename__, 'update', [row_id])
+    return row
+
+# Bot columns whose change rebuilds the typed parameters
+PARAM_COLUMNS = {'param_values', 'strategy_id'}
 
 class Bot(db.Model):
   __tablename__ = 'bot'
+  __table_args__ = (
+    db.Index('ix_bot_strategy_id_timeframe', 'strategy_id', 'timeframe'),
+    db.Index('ix_bot_timeframe', 'timeframe'),
+    db.Index('ix_bot_active', 'id', postgresql_where=db.text('active')),
+  )
 
   id = db.Column(db.Integer, primary_key=True)
   name = db.Column(db.String(20))
@@ -62,25 +337,103 @@ class Bot(db.Model):
   timeframe = db.Column(db.String(5))
   param_values = db.Column(postgresql.ARRAY(db.String))
   strategy_id = db.Column(db.Integer, db.ForeignKey('strategy.id'))
+  created_at = created_at_column()
+  updated_at = updated_at_column()
 
   def format(self):
-    listy = [x for x in self.param_values]
     return {
       'id': self.id,
       'name': self.name,
       'active': self.active,
       'timeframe': self.timeframe,
-      'param_values': listy,
+      'param_values': self.param_values,
       'strategy_id' : self.strategy_id,
     }
 
   def insert(self):
     db.session.add(self)
-    db.session.commit()
+    db.session.flush()
+    sync_bot_params([self.id])
+    commit_changes(self.__tablename__, 'insert', [self.id])
+
+  @classmethod
+  def bulk_insert(cls, rows):
+    ids = bulk_insert(cls.__table__, rows)
+    sync_bot_params(ids)
+    commit_changes(cls.__tablename__, 'insert', ids)
+    return ids
+
+  @classmethod
+  def update_where(cls, clauses, values):
+    ids = update_where(cls.__table__, clauses, values)
+    if not ids:
+      db.session.rollback()
+      return ids
+    if PARAM_COLUMNS & set(values):
+      sync_bot_params(ids)
+    commit_changes(cls.__tablename__, 'update', ids)
+    return ids
+
+  @classmethod
+  def set_active(cls, states, subjects=None):
+    # {bot_id: active} in one UPDATE and one commit, returns {bot_id: row}
+    # for the bots that exist; subjects {bot_id: subject} go in the events
+    table = cls.__table__
+    statement = table.update().where(table.c.id.in_(list(states))) \
+      .values(active=db.case(states, value=table.c.id))
+    if db.session.get_bind().dialect.name == 'postgresql':
+      rows = db.session.execute(statement.returning(*table.c))
+    else:
+      db.session.execute(statement)
+      rows = db.session.query(*table.c).filter(table.c.id.in_(list(states)))
+    rows = {row.id: row for row in rows}
+    if not rows:
+      db.session.rollback()
+      return rows
+    commit_changes(cls.__tablename__, 'update', list(rows), subjects)
+    return rows
+
+  @classmethod
+  def delete_where(cls, clauses):
+    ids = delete_where(cls.__table__, clauses)
+    if not ids:
+      db.session.rollback()
+      return ids
+    commit_changes(cls.__tablename__, 'delete', ids)
+    return ids
 
   def delete(self):
     db.session.delete(self)
-    db.session.commit()
+    commit_changes(self.__tablename__, 'delete', [self.id])
 
   def update(self):
-    db.session.commit()
\ No newline at end of file
+    db.session.flush()
+    sync_bot_params([self.id])
+    commit_changes(self.__tablename__, 'update', [self.id])
+
+  @classmethod
+  def update_by_id(cls, row_id, values):
+    if not values:
+      return db.session.query(*cls.__table__.c).filter(cls.id == row_id).first()
+    row = update_one(cls.__table__, row_id, values)
+    if row is None:
+      # Nothing changed, the version and the caches stay as they are
+      db.session.rollback()
+      return None
+    if PARAM_COLUMNS & set(values):
+      sync_bot_params([row_id])
+    commit_changes(cls.__tablename__, 'update', [row_id])
+    return row
+
+class BotParam(db.Model):
+  __tablename__ = 'bot_param'
+  __table_args__ = (
+    db.Index('ix_bot_param_name_num_value', 'name', 'num_value'),
+    db.Index('ix_bot_param_name_value', 'name', 'value'),
+  )
+
+  bot_id = db.Column(db.Integer, db.ForeignKey('bot.id', ondelete='CASCADE'), primary_key=True)
+  position = db.Column(db.Integer, primary_key=True)
+  name = db.Column(db.String, nullable=False)
+  value = db.Column(db.String)
+  num_value = db.Column(db.Float)
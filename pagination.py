@@ -0,0 +1,105 @@
+import base64, json, os
+from flask import abort, request
+
+from serializers import jsonify
+
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 100))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+
+
+'''
+encode_cursor(key) and decode_cursor(cursor) methods
+
+    The cursor is an opaque url-safe token wrapping the last key of a page
+    - decode_cursor aborts with 400 when the token was not produced by
+      encode_cursor, or does not wrap an integer key
+'''
+
+def encode_cursor(key):
+    data = json.dumps({'after': key}, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        after = json.loads(data)['after']
+    except Exception:
+        abort(400)
+    if not isinstance(after, int) or isinstance(after, bool):
+        abort(400)
+    return after
+
+
+'''
+Page class
+
+    Keyset pagination for the listing routes, driven by ?limit= and ?cursor=
+
+    - Page.from_request() reads the query string, from_args(args) any mapping
+        + without limit and cursor the page is disabled and the listing
+          keeps its original shape, a plain JSON array of every row
+        + limit is capped to MAX_PAGE_SIZE, a non positive limit is a 400
+    - fetch(query, column) returns the rows of the page, ordered by column
+      and starting after the cursor, so every page is one index range scan
+        + trim(rows, key) drops the extra row fetched to detect the next page
+    - response(records) wraps the page as {'items': [...], 'next_cursor': ...}
+        + next_cursor is None on the last page
+'''
+
+class Page:
+    def __init__(self, limit=None, after=None):
+        self.limit = limit
+        self.after = after
+        self.next_cursor = None
+
+    @property
+    def enabled(self):
+        return self.limit is not None
+
+    @classmethod
+    def from_request(cls):
+        return cls.from_args(request.args)
+
+    @classmethod
+    def from_args(cls, args):
+        limit = args.get('limit')
+        cursor = args.get('cursor')
+        if limit is None and cursor is None:
+            return cls()
+
+        try:
+            limit = int(limit) if limit is not None else DEFAULT_PAGE_SIZE
+        except ValueError:
+            abort(400)
+        if limit < 1:
+            abort(400)
+
+        after = decode_cursor(cursor) if cursor else None
+        return cls(min(limit, MAX_PAGE_SIZE), after)
+
+    def fetch(self, query, column):
+        if not self.enabled:
+            return query.all()
+
+        if self.after is not None:
+            query = query.filter(column > self.after)
+        rows = query.order_by(column).limit(self.limit + 1).all()
+        return self.trim(rows, lambda row: getattr(row, column.key))
+
+    def trim(self, rows, key):
+        if len(rows) > self.limit:
+            rows = rows[:self.limit]
+            self.next_cursor = encode_cursor(key(rows[-1]))
+        return rows
+
+    def body(self, records):
+        if not self.enabled:
+            return records
+        return {
+            'items': records,
+            'next_cursor': self.next_cursor
+        }
+
+    def response(self, records):
+        return jsonify(self.body(records))
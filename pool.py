@@ -0,0 +1,152 @@
+import os, threading, time
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+from metrics import POOL_CHECKED_OUT, POOL_OVERFLOW, POOL_TIMEOUTS, POOL_WAIT_SECONDS
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+# Transaction pooling: no LISTEN, no server-side prepared statements
+PGBOUNCER = os.environ.get('DB_PGBOUNCER', '0') == '1'
+
+
+'''
+PoolStats class
+
+    Cumulative counters of one connection pool of this worker, every
+    TimedQueuePool keeps its own (pool.stats)
+    - checkouts, wait time (total and max, in ms) spent getting a connection
+      out of the pool, including opening a new one when it was empty
+    - timeouts (no connection within DB_POOL_TIMEOUT)
+    - connects, and invalidations (dead connections dropped by pre-ping or
+      after a disconnect error)
+'''
+
+class PoolStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.checkouts = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+            self.timeouts = 0
+            self.connects = 0
+            self.invalidations = 0
+
+    def waited(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def timed_out(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def connected(self, *args):
+        with self._lock:
+            self.connects += 1
+
+    def invalidated(self, *args):
+        with self._lock:
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'wait_ms_total': round(self.wait_total * 1e3, 3),
+                'wait_ms_max': round(self.wait_max * 1e3, 3),
+                'timeouts': self.timeouts,
+                'connects': self.connects,
+                'invalidations': self.invalidations
+            }
+
+
+'''
+TimedQueuePool class
+
+    QueuePool recording its checkouts in its own PoolStats and in the
+    db_pool_* metrics, labelled with bind ('primary' until the engine is
+    handed out for another bind, see replica.RoutingSQLAlchemy)
+'''
+
+class TimedQueuePool(QueuePool):
+    bind = 'primary'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+        event.listen(self, 'connect', self.stats.connected)
+        event.listen(self, 'invalidate', self.stats.invalidated)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.timed_out()
+            POOL_TIMEOUTS.labels(self.bind).inc()
+            raise
+        waited = time.perf_counter() - start
+        self.stats.waited(waited)
+        POOL_WAIT_SECONDS.labels(self.bind).observe(waited)
+        self._update_gauges()
+        return connection
+
+    def _do_return_conn(self, conn):
+        super()._do_return_conn(conn)
+        self._update_gauges()
+
+    def _update_gauges(self):
+        POOL_CHECKED_OUT.labels(self.bind).set(self.checkedout())
+        POOL_OVERFLOW.labels(self.bind).set(max(self.overflow(), 0))
+
+
+'''
+engine_options(database_path)
+    SQLAlchemy engine options for the database, from the DB_POOL_* variables
+    - Postgres gets a TimedQueuePool of DB_POOL_SIZE connections plus up to
+      DB_MAX_OVERFLOW more, recycled after DB_POOL_RECYCLE seconds and
+      pinged on checkout, so connections killed by a failover are replaced
+      instead of surfacing as 500s
+    - other databases (SQLite test runs) keep their default pool
+'''
+def engine_options(database_path):
+    if not database_path.startswith('postgres'):
+        return {}
+    return {
+        # Batch executemany() into multi-row INSERTs (bulk endpoints)
+        'executemany_mode': 'values',
+        'poolclass': TimedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING
+    }
+
+
+'''
+pool_status(engine)
+    live state of the engine's pool (size, checked out, checked in,
+    overflow) merged with the cumulative stats of that pool
+'''
+def pool_status(engine):
+    pool = engine.pool
+    status = {'pool': type(pool).__name__, 'pgbouncer': PGBOUNCER}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0)
+        })
+    if isinstance(pool, TimedQueuePool):
+        status.update(pool.stats.stats())
+    return status
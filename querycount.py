@@ -0,0 +1,125 @@
+import json, logging, re, threading
+from collections import Counter
+from contextlib import ContextDecorator
+from functools import wraps
+from flask import current_app, request
+from prometheus_client import Counter as MetricCounter
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+QUERY_BUDGET_EXCEEDED = MetricCounter(
+    'query_budget_exceeded_total', 'Requests over their query budget', ['endpoint'])
+
+_active = threading.local()
+
+
+'''
+fingerprint(statement)
+    the statement with literals and bound parameters replaced by ?, so the
+    same query run for different rows gives the same fingerprint
+'''
+
+LITERALS = re.compile(r"%\(\w+\)s|\$\d+|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+PLACEHOLDER_LISTS = re.compile(r'\?(?:\s*,\s*\?)+')
+
+def fingerprint(statement):
+    statement = LITERALS.sub('?', statement)
+    statement = PLACEHOLDER_LISTS.sub('?', statement)
+    return ' '.join(statement.split())
+
+
+'''
+QueryCounter class
+
+    Counts the SQL statements run by the current thread, on any engine,
+    while it is active. Nests, and works as a decorator:
+
+        with QueryCounter() as counter:
+            ...
+        counter.count, counter.statements
+
+        @QueryCounter()
+        def f(): ...
+
+    - most_repeated() returns (fingerprint, times) of the statement run the
+      most times, the usual sign of an N+1 loop
+'''
+
+class QueryCounter(ContextDecorator):
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def most_repeated(self):
+        if not self.statements:
+            return None, 0
+        return Counter(map(fingerprint, self.statements)).most_common(1)[0]
+
+    def __enter__(self):
+        self.statements = []
+        if not hasattr(_active, 'counters'):
+            _active.counters = []
+        _active.counters.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _active.counters.remove(self)
+        return False
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    for counter in getattr(_active, 'counters', ()):
+        counter.statements.append(statement)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+'''
+@query_budget(limit) decorator method
+
+    Required inputs:
+        limit: most SQL statements one request to the route may run
+
+    - Goes right below @app.route, so it counts the whole request
+    - Over budget, a testing app raises QueryBudgetExceeded (the test fails),
+      otherwise a structured warning is logged with the most repeated
+      statement fingerprint, and query_budget_exceeded_total is incremented
+    - Statements run while streaming the response body are not counted
+'''
+
+def query_budget(limit):
+    def query_budget_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with QueryCounter() as counter:
+                response = f(*args, **kwargs)
+            if counter.count > limit:
+                over_budget(limit, counter)
+            return response
+        return wrapper
+    return query_budget_decorator
+
+
+def over_budget(limit, counter):
+    statement, repeats = counter.most_repeated()
+    report = {
+        'event': 'query_budget_exceeded',
+        'endpoint': request.url_rule.rule,
+        'method': request.method,
+        'budget': limit,
+        'count': counter.count,
+        'fingerprint': statement,
+        'repeats': repeats
+    }
+    if current_app.testing:
+        raise QueryBudgetExceeded(json.dumps(report))
+    QUERY_BUDGET_EXCEEDED.labels(report['endpoint']).inc()
+    logger.warning(json.dumps(report))
@@ -0,0 +1,187 @@
+import os, threading, time
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm, text
+
+from metrics import REPLICA_LAG_SECONDS, REPLICA_READS
+
+REPLICA_BIND = 'replica'
+# Seconds the reads of a subject stay on the primary after its writes
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+# Replication lag in seconds past which reads leave the replica
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 10))
+# Seconds between two lag checks of a worker
+REPLICA_LAG_CHECK = float(os.environ.get('REPLICA_LAG_CHECK', 1))
+# Sticky subjects kept before the expired ones are dropped
+REPLICA_STICKY_MAX = 10000
+
+# 0 while the replica has replayed all it received, the age of the last
+# replayed transaction otherwise; NULL on a server that is not a standby
+REPLICA_LAG = '''
+SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+  ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END
+'''
+
+
+def current_subject():
+    return g.get('subject') if has_request_context() else None
+
+
+def replica_lag(engine):
+    if engine.dialect.name != 'postgresql':
+        return 0.0
+    with engine.connect() as connection:
+        return float(connection.execute(text(REPLICA_LAG)).scalar() or 0)
+
+
+'''
+ReplicaRouter class
+
+    Decides which database the reads of a request go to, when a replica
+    bind is configured (DATABASE_REPLICA_URL)
+
+    - reads(engine) is True for GET and HEAD requests, decided once per
+      request, unless
+        + the subject of the token wrote in the last REPLICA_STICKY_SECONDS,
+          so it reads its own writes from the primary
+        + the replica lags more than REPLICA_MAX_LAG seconds, or could not
+          be checked lately; the lag is measured every REPLICA_LAG_CHECK
+          seconds by a background thread of the worker, so the probe is
+          neither on the request path nor in its query count and metrics
+    - wrote(event) makes the subject of a row event sticky, events come
+      from the commits of this worker and through LISTEN from the others
+    - stick(subject) makes a subject sticky on this worker only
+    - shared_events() tells whether the row events of the other workers
+      reach this one; when they do not (PgBouncer without a LISTEN
+      connection) a write elsewhere could not make its subject sticky here,
+      so every read goes to the primary
+    - check(engine) runs one lag check, reset() drops the sticky subjects
+      and the last check and wakes the thread for a new one
+'''
+
+class ReplicaRouter:
+    def __init__(self, sticky_seconds=REPLICA_STICKY_SECONDS, max_lag=REPLICA_MAX_LAG,
+                 check_interval=REPLICA_LAG_CHECK, measure=replica_lag, clock=time.monotonic,
+                 shared_events=lambda: True):
+        self.sticky_seconds = sticky_seconds
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.measure = measure
+        self.clock = clock
+        self.shared_events = shared_events
+        self.lag = None
+        self.checked_at = None
+        self._sticky = {}
+        self._engine = None
+        self._thread = None
+        self._starting = threading.Lock()
+        self._checked = threading.Event()
+        self._wake = threading.Event()
+
+    def stick(self, subject):
+        if subject is None:
+            return
+        now = self.clock()
+        if len(self._sticky) >= REPLICA_STICKY_MAX:
+            self._sticky = {s: until for s, until in self._sticky.items() if until > now}
+        self._sticky[subject] = now + self.sticky_seconds
+
+    def wrote(self, event):
+        self.stick(event.get('subject'))
+
+    def is_sticky(self, subject):
+        until = self._sticky.get(subject)
+        if until is None:
+            return False
+        if until <= self.clock():
+            self._sticky.pop(subject, None)
+            return False
+        return True
+
+    def check(self, engine):
+        try:
+            lag = self.measure(engine)
+            REPLICA_LAG_SECONDS.set(lag)
+        except Exception:
+            lag = None
+        self.lag, self.checked_at = lag, self.clock()
+        self._checked.set()
+
+    def _run(self):
+        while True:
+            self.check(self._engine)
+            self._wake.wait(self.check_interval)
+            self._wake.clear()
+
+    def _start(self, engine):
+        self._engine = engine
+        # Threads do not survive a fork, each worker starts its own
+        if self._thread is None or not self._thread.is_alive():
+            with self._starting:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+        # Only the first reads of a worker wait, for its first check
+        self._checked.wait(self.check_interval)
+
+    def usable(self):
+        # A check stuck on an unreachable replica leaves a stale result
+        fresh = self.checked_at is not None and \
+            self.clock() - self.checked_at <= 3 * self.check_interval
+        return fresh and self.lag is not None and self.lag <= self.max_lag
+
+    def healthy(self, engine):
+        self._start(engine)
+        return self.usable()
+
+    def reads(self, engine):
+        if not has_request_context() or request.method not in ('GET', 'HEAD'):
+            return False
+        if 'read_replica' not in g:
+            g.read_replica = self.shared_events() and \
+                not self.is_sticky(current_subject()) and self.healthy(engine)
+            REPLICA_READS.labels(REPLICA_BIND if g.read_replica else 'primary').inc()
+        return g.read_replica
+
+    def reset(self):
+        self.lag = self.checked_at = None
+        self._sticky = {}
+        self._checked.clear()
+        self._wake.set()
+
+
+replica_router = ReplicaRouter()
+
+
+'''
+RoutingSQLAlchemy and RoutingSession classes
+
+    The SQLAlchemy service of models.db and its session, which sends the
+    statements of the requests replica_router picks to the replica bind,
+    everything else to the primary
+    - get_engine names the pool of each bind, so the pool metrics and
+      /pool-stats keep the primary and the replica apart
+'''
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def get_engine(self, app=None, bind=None):
+        engine = super().get_engine(app, bind)
+        if bind is not None:
+            engine.pool.bind = bind
+        return engine
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        self._db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if REPLICA_BIND in (self.app.config.get('SQLALCHEMY_BINDS') or {}):
+            engine = self._db.get_engine(self.app, bind=REPLICA_BIND)
+            if replica_router.reads(engine):
+                return engine
+        return super().get_bind(mapper, clause)
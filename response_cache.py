@@ -0,0 +1,121 @@
+import os, threading
+from collections import OrderedDict
+from functools import wraps
+from flask import make_response, request
+from changes import change_listener
+from etags import make_etag
+
+RESPONSE_CACHE_BYTES = int(os.environ.get('RESPONSE_CACHE_BYTES', 32 * 1024 * 1024))
+
+
+'''
+ResponseCache class
+
+    LRU of serialized response bodies, bounded by their total size in bytes.
+
+    - Each entry remembers the table versions it was built from, and is only
+      served while the change listener still reports the same versions
+    - hits, misses and evictions counters are kept for monitoring
+'''
+
+class ResponseCache:
+    def __init__(self, max_bytes=RESPONSE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, versions):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == versions:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            return None
+
+    def put(self, key, versions, body, mimetype, etag):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self._entries[key] = (versions, body, mimetype, etag)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted[1])
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+response_cache = ResponseCache()
+
+
+'''
+@cached_listing(*tables) decorator method
+
+    Required inputs:
+        tables: names of the tables the listing reads ('bot', 'strategy')
+
+    - Serves the stored body of a public listing while its tables are
+      unchanged, answering If-None-Match from the stored ETag
+    - Otherwise runs the route and stores its 200 response, when the ETag
+      shows it was read at the versions it is stored under
+    - Streamed responses are never stored
+    - Sets X-Cache: HIT or MISS on the response
+'''
+
+def cached_listing(*tables):
+    def cached_listing_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key = f'{request.full_path}|{request.headers.get("Accept", "")}'
+            versions = change_listener.versions(tables)
+            entry = response_cache.get(key, versions) if versions is not None else None
+
+            if entry is not None:
+                _, body, mimetype, etag = entry
+                if etag is not None and request.if_none_match.contains(etag):
+                    response = make_response('', 304)
+                else:
+                    response = make_response(body)
+                    response.mimetype = mimetype
+                if etag is not None:
+                    response.set_etag(etag)
+                response.headers['X-Cache'] = 'HIT'
+                return response
+
+            response = make_response(f(*args, **kwargs))
+            # Only a body read at those versions is stored, not one from a
+            # replica that has not caught up
+            if versions is not None and response.status_code == 200 \
+                    and not response.is_streamed \
+                    and response.get_etag()[0] == make_etag(dict(zip(tables, versions)), tables, key):
+                response_cache.put(key, versions, response.get_data(),
+                                   response.mimetype, response.get_etag()[0])
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return cached_listing_decorator
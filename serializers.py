@@ -0,0 +1,47 @@
+import json
+from flask import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON = 'application/json'
+
+
+'''
+dumps(obj) method
+
+    - Serializes a response body with orjson, or with the json module when
+      orjson is not installed
+    - Lists and tuples are written as they are, so ARRAY columns and row
+      values need no copy
+    - Returns bytes, ready for a response body or a stream chunk
+'''
+
+if orjson is not None:
+    def dumps(obj):
+        return orjson.dumps(obj)
+else:
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+
+'''
+JSONResponse class and jsonify(obj) method
+
+    - JSONResponse is a Flask Response with a JSON body, built from any
+      object dumps() takes
+    - jsonify(obj) stands in for flask.jsonify in the routes and error
+      handlers
+'''
+
+class JSONResponse(Response):
+    default_mimetype = JSON
+
+    def __init__(self, obj=None, status=None, headers=None):
+        super().__init__(dumps(obj), status=status, headers=headers)
+
+
+def jsonify(obj):
+    return JSONResponse(obj)
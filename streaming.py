@@ -0,0 +1,50 @@
+import os
+from flask import Response, request, stream_with_context
+
+from serializers import dumps
+
+NDJSON = 'application/x-ndjson'
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 1000))
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+'''
+wants_stream() method
+
+    - Returns True when the client asked for NDJSON, either with
+      Accept: application/x-ndjson or with ?stream=1
+'''
+
+def wants_stream():
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+    return request.accept_mimetypes.best == NDJSON
+
+
+'''
+stream_ndjson(query, column, serialize) method
+
+    - Streams the query as one JSON object per line, ordered by column
+    - Rows are read through a server-side cursor (yield_per) in batches of
+      STREAM_BATCH_SIZE and serialized one at a time, lines are sent in
+      chunks of about STREAM_CHUNK_BYTES, so memory stays flat whatever the
+      size of the table
+    - Returns a chunked Response
+'''
+
+def stream_ndjson(query, column, serialize):
+    rows = query.order_by(column).yield_per(STREAM_BATCH_SIZE)
+
+    def generate():
+        chunk, size = [], 0
+        for row in rows:
+            line = dumps(serialize(row)) + b'\n'
+            chunk.append(line)
+            size += len(line)
+            if size >= STREAM_CHUNK_BYTES:
+                yield b''.join(chunk)
+                chunk, size = [], 0
+        if chunk:
+            yield b''.join(chunk)
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON)
@@ -1,9 +1,29 @@
 import os
+import time
+import threading
+from datetime import datetime, timedelta, timezone
 import unittest
+from unittest import mock
 import json
 from flask_sqlalchemy import SQLAlchemy
 from app import create_app
-from models import setup_db, Strategy, Bot
+from models import setup_db, db, Strategy, Bot, change_hooks, row_hooks, table_versions
+import auth
+from auth import JWKSStore, TokenCache
+from pagination import encode_cursor, MAX_PAGE_SIZE
+from delta import encode_since, SYNC_TOMBSTONE_DAYS
+from response_cache import ResponseCache
+from serializers import JSONResponse, dumps
+from sqlalchemy import create_engine, exc
+from pool import TimedQueuePool, engine_options, pool_status
+from warmup import warm_up
+from feed import ChangeFeed
+from changes import ChangeListener, change_listener
+from coalesce import ActiveWrites
+from replica import ReplicaRouter, replica_router, REPLICA_BIND
+from querycount import QueryCounter, QueryBudgetExceeded, fingerprint, query_budget
+from prometheus_client import REGISTRY
+from benchmarks.local_auth import LocalAuth, TRADER_PERMISSIONS, QUANT_MANAGER_PERMISSIONS
 
 # Preventing random test order
 
@@ -321,5 +341,1023 @@ class TradingBotsTestCase(unittest.TestCase):
         self.assertTrue(data['success'])
 
 
+# Base case with tokens signed with a local key, bots are created under strategy 1000
+
+class LocalAuthTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app({'TESTING': True})
+        self.client = self.app.test_client()
+        self.local = LocalAuth().install()
+        self.headers = {
+            "Authorization": f"Bearer {self.local.token(TRADER_PERMISSIONS)}"
+        }
+        self.quant_headers = {
+            "Authorization": f"Bearer {self.local.token(QUANT_MANAGER_PERMISSIONS)}"
+        }
+        with self.app.app_context():
+            db.create_all()
+            Strategy(id=1000, name='Query Count', params=['window']).insert()
+
+    def tearDown(self):
+        with self.app.app_context():
+            Bot.query.filter(Bot.strategy_id == 1000).delete()
+            Strategy.query.filter(Strategy.id == 1000).delete()
+            db.session.commit()
+
+    def add_bots(self, start, count):
+        with self.app.app_context():
+            for bot_id in range(start, start + count):
+                db.session.add(Bot(id=bot_id, name=f'Bot {bot_id}', active=True,
+                                   timeframe='1h', strategy_id=1000, param_values=['7']))
+            db.session.commit()
+
+
+# Listings
+
+class ListingTestCase(LocalAuthTestCase):
+    def count_queries(self, url):
+        with QueryCounter() as counter:
+            res = self.client.get(url, headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        return counter.count
+
+    def test_bots_detail_query_count_is_fixed(self):
+        self.add_bots(1000, 2)
+        few = self.count_queries('/bots-detail')
+        self.add_bots(1002, 50)
+        many = self.count_queries('/bots-detail')
+        self.assertEqual(few, many)
+        # Table versions for the ETag, then the listing itself
+        self.assertEqual(many, 2)
+
+    def test_listing_without_cursor_keeps_shape(self):
+        self.add_bots(1000, 3)
+        res = self.client.get('/bots')
+        self.assertIsInstance(json.loads(res.data), list)
+
+    def test_bots_keyset_pagination(self):
+        self.add_bots(1000, 5)
+        ids = []
+        url = '/bots-detail?limit=2&cursor=' + encode_cursor(999)
+        while True:
+            res = self.client.get(url, headers=self.headers)
+            self.assertEqual(res.status_code, 200)
+            data = json.loads(res.data)
+            self.assertLessEqual(len(data['items']), 2)
+            ids += [bot['id'] for bot in data['items']]
+            if data['next_cursor'] is None:
+                break
+            url = '/bots-detail?limit=2&cursor=' + data['next_cursor']
+        self.assertEqual([bot_id for bot_id in ids if bot_id >= 1000], list(range(1000, 1005)))
+
+    def test_page_size_is_capped(self):
+        res = self.client.get(f'/strategies?limit={MAX_PAGE_SIZE + 1}')
+        self.assertEqual(res.status_code, 200)
+        self.assertLessEqual(len(json.loads(res.data)['items']), MAX_PAGE_SIZE)
+
+    def test_bots_detail_stream(self):
+        self.add_bots(1000, 3)
+        res = self.client.get(
+            '/bots-detail',
+            headers={**self.headers, "Accept": "application/x-ndjson"}
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        bots = [json.loads(line) for line in res.data.decode().splitlines()]
+        self.assertEqual([bot['id'] for bot in bots if bot['id'] >= 1000], [1000, 1001, 1002])
+
+    def test_etag_not_modified(self):
+        etag = self.client.get('/bots').headers['ETag']
+        res = self.client.get('/bots', headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+
+    def test_etag_changes_on_write(self):
+        etag = self.client.get('/bots').headers['ETag']
+        with self.app.app_context():
+            Bot(id=1000, name='Bot 1000', active=True, timeframe='1h',
+                strategy_id=1000, param_values=['7']).insert()
+        res = self.client.get('/bots', headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_bots_detail_filters(self):
+        self.add_bots(1000, 4)
+        with self.app.app_context():
+            Bot.query.filter(Bot.id.in_([1001, 1003])) \
+                .update({'active': False, 'timeframe': '4h'}, synchronize_session=False)
+            db.session.commit()
+        res = self.client.get(
+            '/bots-detail?strategy_id=1000&active=false&timeframe=4h',
+            headers=self.headers
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([bot['id'] for bot in json.loads(res.data)], [1001, 1003])
+
+    def test_bad_filter(self):
+        res = self.client.get('/bots?strategy_id=abc')
+        self.assertEqual(res.status_code, 400)
+
+    def test_sparse_fieldset(self):
+        self.add_bots(1000, 2)
+        res = self.client.get('/bots-detail?strategy_id=1000&fields=id,active,strategy', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)[0], {'id': 1000, 'active': True, 'strategy': 'Query Count'})
+
+    def test_unknown_field(self):
+        res = self.client.get('/bots?fields=id,secret')
+        self.assertEqual(res.status_code, 400)
+
+    def test_bad_cursor(self):
+        res = self.client.get('/bots?cursor=not-a-cursor')
+        self.assertEqual(res.status_code, 400)
+
+    def test_cursor_key_must_be_an_integer(self):
+        for key in ('1000', 10.5, True, None, [1000], {'id': 1000}):
+            res = self.client.get('/bots?cursor=' + encode_cursor(key))
+            self.assertEqual(res.status_code, 400, key)
+
+
+# Bulk create
+
+class BulkTestCase(LocalAuthTestCase):
+    def bot(self, bot_id, **fields):
+        row = {
+            'id': bot_id,
+            'name': f'Bot {bot_id}',
+            'active': True,
+            'strategy_id': 1000,
+            'timeframe': '1h',
+            'param_values': '7, price'
+        }
+        row.update(fields)
+        return row
+
+    def test_bulk_bots_json(self):
+        res = self.client.post(
+            '/bots/bulk',
+            json=[self.bot(1000), self.bot(1001)],
+            headers=self.quant_headers
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([row['id'] for row in data['results']], [1000, 1001])
+        with self.app.app_context():
+            self.assertEqual(Bot.query.filter(Bot.strategy_id == 1000).count(), 2)
+
+    def test_bulk_bots_ndjson(self):
+        body = '\n'.join(json.dumps(self.bot(bot_id)) for bot_id in range(1000, 1003))
+        res = self.client.post(
+            '/bots/bulk',
+            data=body,
+            content_type='application/x-ndjson',
+            headers=self.quant_headers
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['count'], 3)
+
+    def test_bulk_bots_invalid_row_inserts_nothing(self):
+        res = self.client.post(
+            '/bots/bulk',
+            json=[self.bot(1000), self.bot(1001, active='yes')],
+            headers=self.quant_headers
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['results'][0]['index'], 1)
+        with self.app.app_context():
+            self.assertEqual(Bot.query.filter(Bot.strategy_id == 1000).count(), 0)
+
+    def test_bulk_bots_rejects_unhashable_and_bool_values(self):
+        rows = [
+            self.bot([1000]),
+            self.bot({'id': 1001}),
+            self.bot(1002, strategy_id=[1000]),
+            self.bot(1003, strategy_id={'id': 1000}),
+            self.bot(1004, strategy_id=True),
+            self.bot(True)
+        ]
+        res = self.client.post('/bots/bulk', json=rows, headers=self.quant_headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual([row['index'] for row in data['results']], list(range(6)))
+        self.assertIn('id must be an integer', data['results'][0]['errors'])
+        self.assertIn('strategy_id must reference an existing strategy', data['results'][4]['errors'])
+        with self.app.app_context():
+            self.assertEqual(Bot.query.filter(Bot.strategy_id == 1000).count(), 0)
+
+    def test_generated_ids_skip_bulk_ids(self):
+        with self.app.app_context():
+            next_id = (db.session.query(db.func.max(Bot.id)).scalar() or 0) + 1
+        res = self.client.post('/bots/bulk', json=[self.bot(next_id), self.bot(next_id + 1)],
+                               headers=self.quant_headers)
+        self.assertEqual(res.status_code, 200)
+        res = self.client.post('/bots/create', json={
+            'name': 'Generated', 'active': True, 'strategy_id': 1000,
+            'timeframe': '1h', 'param_values': '7'
+        }, headers=self.quant_headers)
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            self.assertEqual(Bot.query.filter(Bot.strategy_id == 1000).count(), 3)
+
+    def test_bulk_bots_without_permission(self):
+        res = self.client.post('/bots/bulk', json=[self.bot(1000)], headers=self.headers)
+        self.assertEqual(res.status_code, 401)
+
+
+# Change feed
+
+class ChangeFeedTestCase(unittest.TestCase):
+    def event(self, version, ids, op='update'):
+        return {'table': 'bot', 'version': version, 'op': op, 'start': 0, 'ids': ids}
+
+    def test_resume_after_last_event_id(self):
+        feed = ChangeFeed(size=10)
+        feed.publish(self.event(1, [5, 6]))
+        feed.publish(self.event(2, [7]))
+        queue, backlog = feed.subscribe('bot.1.0')
+        self.assertEqual([change['row'] for change in backlog], [6, 7])
+        feed.publish(self.event(3, [8], 'delete'))
+        self.assertEqual(queue.get_nowait(),
+                         [{'id': 'bot.3.0', 'table': 'bot', 'op': 'delete', 'row': 8}])
+
+    def test_lost_resume_point_and_slow_subscriber(self):
+        feed = ChangeFeed(size=2, queue_size=1)
+        feed.publish(self.event(1, [1, 2, 3]))
+        queue, backlog = feed.subscribe('bot.1.0')
+        self.assertIsNone(backlog)
+        feed.publish(self.event(2, [4]))
+        feed.publish(self.event(3, [5]))
+        self.assertEqual(queue.get_nowait()[0]['row'], 4)
+        self.assertIsNone(queue.get_nowait())
+
+
+class ChangeListenerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.listener = ChangeListener()
+        change_hooks.remove(self.listener._forget)
+        self.listener._versions = {'bot': 5}
+
+    def test_local_write_records_its_version(self):
+        self.listener._forget('bot', 6)
+        self.assertEqual(self.listener.versions(['bot']), (6,))
+
+    def test_local_write_keeps_newer_version(self):
+        self.listener._forget('bot', 4)
+        self.assertEqual(self.listener.versions(['bot']), (5,))
+
+
+class ChangeStreamTestCase(LocalAuthTestCase):
+    def setUp(self):
+        super().setUp()
+        heartbeat = mock.patch('feed.SSE_HEARTBEAT', 0.1)
+        heartbeat.start()
+        self.addCleanup(heartbeat.stop)
+
+    def test_stream_pushes_route_changes(self):
+        self.add_bots(1000, 1)
+        res = self.client.get('/bots/changes', headers=self.headers, buffered=False)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        deadline = time.time() + 5
+        while change_listener.versions(['bot']) is None and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIsNotNone(change_listener.versions(['bot']), 'change listener not started')
+
+        self.client.post('/bots/create', json={
+            'id': 1001, 'name': 'Fed', 'active': True, 'strategy_id': 1000,
+            'timeframe': '1h', 'param_values': '7'
+        }, headers=self.quant_headers)
+        self.client.delete('/bots/1000', headers=self.quant_headers)
+        chunks = iter(res.response)
+        events = []
+        # Keep-alives every 0.1s let the loop check its deadline
+        deadline = time.time() + 5
+        while len(events) < 2 and time.time() < deadline:
+            chunk = next(chunks)
+            chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+            events += [json.loads(line[6:]) for line in chunk.splitlines()
+                       if line.startswith('data: {"id"')]
+        res.close()
+        self.assertEqual([(e['op'], e['row']) for e in events], [('insert', 1001), ('delete', 1000)])
+
+    def test_stream_refused_without_shared_events(self):
+        with mock.patch.object(change_listener, 'local_only', True):
+            res = self.client.get('/bots/changes', headers=self.headers)
+        self.assertEqual(res.status_code, 503)
+
+    def test_stream_needs_token(self):
+        res = self.client.get('/bots/changes')
+        self.assertEqual(res.status_code, 401)
+
+
+# Delta sync with ?since=
+
+class DeltaSyncTestCase(LocalAuthTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_bots(1000, 3)
+        # Rows last written two days ago, synced an hour ago
+        with self.app.app_context():
+            old = datetime.now(timezone.utc) - timedelta(days=2)
+            Bot.query.filter(Bot.strategy_id == 1000).update({'updated_at': old})
+            Strategy.query.filter(Strategy.id == 1000).update({'updated_at': old})
+            db.session.commit()
+        self.since = encode_since(datetime.now(timezone.utc) - timedelta(hours=1))
+
+    def sync(self, url, since):
+        res = self.client.get(f'{url}?since={since}', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)
+
+    def test_sync_from_scratch(self):
+        data = self.sync('/bots', '0')
+        self.assertEqual([bot['id'] for bot in data['changed'] if bot['id'] >= 1000], [1000, 1001, 1002])
+        self.assertEqual(data['deleted'], [])
+        self.assertNotEqual(data['since'], '0')
+
+    def test_changed_and_deleted_rows(self):
+        with self.app.app_context():
+            Bot.query.filter(Bot.id == 1001).update({'name': 'Renamed'})
+            db.session.commit()
+        self.client.delete('/bots/1002', headers=self.quant_headers)
+
+        data = self.sync('/bots', self.since)
+        self.assertEqual([(bot['id'], bot['name']) for bot in data['changed']], [(1001, 'Renamed')])
+        self.assertEqual(data['deleted'], [1002])
+        self.assertIsInstance(data['since'], str)
+
+    def test_recreated_row_is_not_deleted(self):
+        self.client.delete('/bots/1002', headers=self.quant_headers)
+        self.add_bots(1002, 1)
+        data = self.sync('/bots', self.since)
+        self.assertEqual([bot['id'] for bot in data['changed']], [1002])
+        self.assertEqual(data['deleted'], [])
+
+    def test_strategy_change_syncs_its_bots(self):
+        with self.app.app_context():
+            Strategy.query.filter(Strategy.id == 1000).update({'name': 'Renamed'})
+            db.session.commit()
+        data = self.sync('/bots-detail', self.since)
+        self.assertEqual([bot['id'] for bot in data['changed']], [1000, 1001, 1002])
+        self.assertEqual({bot['strategy'] for bot in data['changed']}, {'Renamed'})
+        self.assertEqual(self.sync('/bots', self.since)['changed'], [])
+
+    def test_sync_with_fields(self):
+        with self.app.app_context():
+            Bot.query.filter(Bot.id == 1000).update({'active': False})
+            db.session.commit()
+        data = self.sync('/bots-detail', self.since + '&fields=id,active')
+        self.assertEqual(data['changed'], [{'id': 1000, 'active': False}])
+
+    def test_bad_tokens(self):
+        expired = encode_since(datetime.now(timezone.utc) - timedelta(days=SYNC_TOMBSTONE_DAYS + 1))
+        self.assertEqual(self.client.get(f'/bots?since={expired}').status_code, 410)
+        self.assertEqual(self.client.get('/bots?since=garbage').status_code, 400)
+        self.assertEqual(self.client.get(f'/bots?since={self.since}&limit=10').status_code, 400)
+
+
+# Coalesced active toggles
+
+class WriteCoalescingTestCase(LocalAuthTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = create_app({'TESTING': True, 'WRITE_COALESCING': True})
+        self.client = self.app.test_client()
+
+    def active(self, bot_id):
+        with self.app.app_context():
+            return db.session.query(Bot.active).filter(Bot.id == bot_id).scalar()
+
+    def test_last_toggle_wins_in_one_flush(self):
+        self.add_bots(1000, 2)
+        writes = ActiveWrites(self.app, interval=0.05)
+        first = writes.submit(1000, False)
+        last = writes.submit(1000, True)
+        other = writes.submit(1001, False)
+        missing = writes.submit(999999, False)
+
+        self.assertTrue(last.result(5).active)
+        self.assertTrue(first.result(5).active)
+        self.assertFalse(other.result(5).active)
+        self.assertIsNone(missing.result(5))
+        self.assertEqual(writes.flushes, 1)
+        self.assertEqual((self.active(1000), self.active(1001)), (True, False))
+
+    def test_flush_events_carry_subjects(self):
+        self.add_bots(1000, 3)
+        events = []
+        row_hooks.append(events.append)
+        try:
+            writes = ActiveWrites(self.app, interval=0.05)
+            futures = [
+                writes.submit(1000, False, 'auth0|a'),
+                writes.submit(1001, False, 'auth0|b'),
+                writes.submit(1002, False, 'auth0|a')
+            ]
+            for future in futures:
+                future.result(5)
+        finally:
+            row_hooks.remove(events.append)
+        subjects = {row_id: event['subject'] for event in events for row_id in event['ids']}
+        self.assertEqual(subjects, {1000: 'auth0|a', 1001: 'auth0|b', 1002: 'auth0|a'})
+        self.assertEqual(sorted(event['start'] for event in events), [0, 2])
+
+    def test_flush_of_missing_bots_keeps_version(self):
+        with self.app.app_context():
+            version = table_versions(['bot'])['bot']
+        writes = ActiveWrites(self.app, interval=0.01)
+        self.assertIsNone(writes.submit(999999, False).result(5))
+        with self.app.app_context():
+            self.assertEqual(table_versions(['bot'])['bot'], version)
+
+    def test_patch_waits_for_commit(self):
+        self.add_bots(1000, 1)
+        res = self.client.patch('/bots/1000', json={'active': False}, headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(json.loads(res.data)['active'])
+        self.assertFalse(self.active(1000))
+
+    def test_patch_async_acknowledgement(self):
+        self.add_bots(1000, 1)
+        res = self.client.patch('/bots/1000', json={'active': False},
+                                headers={**self.headers, 'Prefer': 'respond-async'})
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(res.headers['Preference-Applied'], 'respond-async')
+        deadline = time.time() + 5
+        while self.active(1000) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(self.active(1000))
+
+    def test_unknown_bot(self):
+        res = self.client.patch('/bots/999999', json={'active': False}, headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+
+
+# Read replica routing, TEST_REPLICA_URL is a second local database
+
+class ReplicaRouterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.lags = [0.5]
+        self.router = ReplicaRouter(sticky_seconds=5, max_lag=10, check_interval=1,
+                                    measure=lambda engine: self.lags[-1],
+                                    clock=lambda: self.now)
+
+    def test_writes_are_sticky_for_a_while(self):
+        self.router.wrote({'table': 'bot', 'subject': 'auth0|a'})
+        self.router.wrote({'table': 'bot', 'subject': None})
+        self.assertTrue(self.router.is_sticky('auth0|a'))
+        self.assertFalse(self.router.is_sticky('auth0|b'))
+        self.now = 5
+        self.assertFalse(self.router.is_sticky('auth0|a'))
+
+    def test_lagging_replica_is_dropped(self):
+        self.router.check(None)
+        self.assertTrue(self.router.usable())
+        self.lags.append(30)
+        self.router.check(None)
+        self.assertFalse(self.router.usable())
+
+    def test_stale_check_is_dropped(self):
+        self.router.check(None)
+        self.now = 3
+        self.assertTrue(self.router.usable())
+        self.now = 4
+        self.assertFalse(self.router.usable())
+
+    def test_unreachable_replica_is_dropped(self):
+        def fail(engine):
+            raise exc.OperationalError('SELECT 1', {}, Exception('down'))
+        self.router.measure = fail
+        self.router.check(None)
+        self.assertFalse(self.router.usable())
+
+    def test_lag_is_checked_off_the_request_thread(self):
+        threads = []
+        def measure(engine):
+            threads.append(threading.current_thread())
+            return 0.5
+        router = ReplicaRouter(check_interval=1, measure=measure)
+        self.assertTrue(router.healthy(None))
+        self.assertNotIn(threading.current_thread(), threads)
+
+
+@unittest.skipUnless(os.environ.get('TEST_REPLICA_URL'), 'needs TEST_REPLICA_URL')
+class ReplicaTestCase(LocalAuthTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_BINDS': {REPLICA_BIND: os.environ['TEST_REPLICA_URL']}
+        })
+        self.client = self.app.test_client()
+        self.writer_headers = {
+            "Authorization": f"Bearer {self.local.token(QUANT_MANAGER_PERMISSIONS, subject='auth0|writer')}"
+        }
+        # Same schema, but the replica never gets the rows of the tests
+        with self.app.app_context():
+            db.Model.metadata.create_all(bind=db.get_engine(self.app, bind=REPLICA_BIND))
+        replica_router.reset()
+
+    def tearDown(self):
+        replica_router.reset()
+        super().tearDown()
+
+    def bot_ids(self, headers):
+        res = self.client.get('/bots-detail', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        return [bot['id'] for bot in json.loads(res.data) if bot['id'] >= 1000]
+
+    def test_reads_go_to_the_replica(self):
+        self.add_bots(1000, 1)
+        self.assertEqual(self.bot_ids(self.headers), [])
+
+    def test_writer_reads_its_writes(self):
+        res = self.client.post('/bots/create', json={
+            'id': 1001, 'name': 'Sticky', 'active': True, 'strategy_id': 1000,
+            'timeframe': '1h', 'param_values': '7'
+        }, headers=self.writer_headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.bot_ids(self.writer_headers), [1001])
+        self.assertEqual(self.bot_ids(self.headers), [])
+
+    def test_primary_without_shared_events(self):
+        self.add_bots(1000, 1)
+        with mock.patch.object(change_listener, 'local_only', True):
+            self.assertEqual(self.bot_ids(self.headers), [1000])
+
+    def test_lagging_replica_is_dropped(self):
+        self.add_bots(1000, 1)
+        measure, replica_router.measure = replica_router.measure, lambda engine: replica_router.max_lag + 1
+        replica_router.reset()
+        try:
+            self.assertEqual(self.bot_ids(self.headers), [1000])
+        finally:
+            replica_router.measure = measure
+            replica_router.reset()
+
+
+# Async mode, the fast listings of asgi.py against the Flask routes;
+# the listings need DATABASE_URL on Postgres, asyncpg has no SQLite
+
+ON_POSTGRES = os.environ.get('DATABASE_URL', '').startswith('postgres')
+
+
+class AsyncModeTestCase(LocalAuthTestCase):
+    def setUp(self):
+        super().setUp()
+        from starlette.testclient import TestClient
+        from asgi import create_asgi_app
+        # Errors are compared as responses, as a client sees them
+        self.asgi = TestClient(create_asgi_app(self.app), raise_server_exceptions=False)
+
+    def assertSameResponse(self, url, headers=None):
+        flask_res = self.client.get(url, headers=headers)
+        asgi_res = self.asgi.get(url, headers=headers)
+        self.assertEqual(asgi_res.status_code, flask_res.status_code, url)
+        self.assertEqual(asgi_res.headers.get('ETag'), flask_res.headers.get('ETag'), url)
+        if flask_res.status_code != 304:
+            self.assertEqual(asgi_res.json(), json.loads(flask_res.data), url)
+        return flask_res
+
+    def test_auth_errors_match(self):
+        no_permissions = {"Authorization": f"Bearer {self.local.token([])}"}
+        for url in ('/strategies-detail', '/bots-detail'):
+            self.assertEqual(self.assertSameResponse(url).status_code, 401)
+            self.assertSameResponse(url, {"Authorization": "Basic abc"})
+            self.assertSameResponse(url, no_permissions)
+
+    def test_greeting_matches(self):
+        self.assertSameResponse('/')
+
+    def test_fast_routes_are_in_the_metrics(self):
+        labels = {'endpoint': '/bots-detail', 'method': 'GET', 'status': '401'}
+        before = REGISTRY.get_sample_value('http_requests_total', labels) or 0
+        self.assertEqual(self.asgi.get('/bots-detail').status_code, 401)
+        self.assertEqual(REGISTRY.get_sample_value('http_requests_total', labels), before + 1)
+
+    @unittest.skipUnless(ON_POSTGRES, 'needs DATABASE_URL on Postgres')
+    def test_listings_match(self):
+        self.add_bots(1000, 3)
+        with self.asgi:
+            for url in ('/strategies', '/strategies-detail', '/bots', '/bots-detail',
+                        '/bots?limit=2', '/bots-detail?strategy_id=1000&active=true',
+                        '/bots?limit=2&ids=1000,1001,1002', '/bots?limit=0'):
+                self.assertSameResponse(url, self.headers)
+
+            first = self.assertSameResponse('/bots-detail?limit=2', self.headers)
+            cursor = json.loads(first.data)['next_cursor']
+            self.assertSameResponse(f'/bots-detail?limit=2&cursor={cursor}', self.headers)
+
+    @unittest.skipUnless(ON_POSTGRES, 'needs DATABASE_URL on Postgres')
+    def test_not_modified_matches(self):
+        self.add_bots(1000, 1)
+        with self.asgi:
+            for url in ('/bots', '/bots-detail?limit=1'):
+                etag = self.client.get(url, headers=self.headers).headers['ETag']
+                res = self.assertSameResponse(url, {**self.headers, 'If-None-Match': etag})
+                self.assertEqual(res.status_code, 304)
+
+
+# CSV export and import through COPY
+
+class TransferTestCase(LocalAuthTestCase):
+    def test_export_bots(self):
+        self.add_bots(1000, 2)
+        res = self.client.get('/bots/export', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/csv')
+        lines = res.data.decode().splitlines()
+        self.assertEqual(lines[0], 'id,name,active,timeframe,param_values,strategy_id')
+        self.assertIn('1000,Bot 1000,t,1h,{7},1000', lines)
+
+    def test_import_upserts_bots(self):
+        self.add_bots(1000, 1)
+        csv = ('id,name,active,timeframe,param_values,strategy_id\n'
+               '1000,Renamed,f,1h,{7},1000\n'
+               '1001,New,t,4h,{9},1000\n')
+        res = self.client.post('/bots/import', data=csv, content_type='text/csv',
+                               headers=self.quant_headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['count'], 2)
+        with self.app.app_context():
+            self.assertEqual(Bot.query.get(1000).name, 'Renamed')
+            self.assertEqual(Bot.query.get(1001).param_values, ['9'])
+
+    def test_import_malformed_csv(self):
+        res = self.client.post('/bots/import', data='id,name\nx,y\n',
+                               content_type='text/csv', headers=self.quant_headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_import_no_permission(self):
+        res = self.client.post('/bots/import', data='', content_type='text/csv',
+                               headers=self.headers)
+        self.assertEqual(res.status_code, 401)
+
+    def test_import_needs_patch_permission(self):
+        post_only = {"Authorization": f"Bearer {self.local.token(['post:bots', 'post:strategies'])}"}
+        for url in ('/bots/import', '/strategies/import'):
+            res = self.client.post(url, data='', content_type='text/csv', headers=post_only)
+            self.assertEqual(res.status_code, 401)
+
+
+# Set-based update and delete by filter
+
+class BotFilterTestCase(LocalAuthTestCase):
+    def test_patch_bots_by_strategy(self):
+        self.add_bots(1000, 3)
+        res = self.client.patch(
+            '/bots?strategy_id=1000',
+            json={"active": False},
+            headers=self.headers
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(data['ids']), [1000, 1001, 1002])
+        with self.app.app_context():
+            self.assertEqual(Bot.query.filter(Bot.strategy_id == 1000, Bot.active).count(), 0)
+
+    def test_patch_bots_without_filter(self):
+        res = self.client.patch('/bots', json={"active": False}, headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_patch_bot_returns_updated_row(self):
+        self.add_bots(1000, 1)
+        res = self.client.patch('/bots/1000', json={"active": False}, headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(data['active'])
+        self.assertEqual(data['name'], 'Bot 1000')
+
+    def version(self, name):
+        with self.app.app_context():
+            return table_versions([name])[name]
+
+    def test_patch_missing_bot(self):
+        res = self.client.patch('/bots/999999', json={"active": False}, headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+
+    def test_filter_matching_nothing_keeps_version(self):
+        version = self.version('bot')
+        res = self.client.patch('/bots?strategy_id=999999', json={"active": False},
+                                headers=self.headers)
+        self.assertEqual(json.loads(res.data)['ids'], [])
+        res = self.client.delete('/bots?strategy_id=999999', headers=self.quant_headers)
+        self.assertEqual(json.loads(res.data)['ids'], [])
+        self.assertEqual(self.version('bot'), version)
+
+    def test_patch_missing_row_keeps_version(self):
+        for name, url in (('bot', '/bots/999999'), ('strategy', '/strategies/999999')):
+            version = self.version(name)
+            res = self.client.patch(url, json={"name": "Missing"}, headers=self.quant_headers)
+            self.assertEqual(res.status_code, 404)
+            self.assertEqual(self.version(name), version)
+
+    def test_search_bots_by_param_range(self):
+        with self.app.app_context():
+            for bot_id, window in ((1000, '5'), (1001, '20'), (1002, '50')):
+                Bot(id=bot_id, name=f'Bot {bot_id}', active=True, timeframe='1h',
+                    strategy_id=1000, param_values=[window]).insert()
+        res = self.client.get(
+            '/bots/search?strategy_id=1000&where=window>=10&where=window<50',
+            headers=self.headers
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([bot['id'] for bot in json.loads(res.data)], [1001])
+
+    def test_search_bots_bad_predicate(self):
+        res = self.client.get('/bots/search?where=window', headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_delete_bots_by_ids(self):
+        self.add_bots(1000, 3)
+        res = self.client.delete('/bots?ids=1000,1002', headers=self.quant_headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(data['ids']), [1000, 1002])
+
+    def test_delete_bots_without_permission(self):
+        res = self.client.delete('/bots?ids=1000', headers=self.headers)
+        self.assertEqual(res.status_code, 401)
+
+
+# Serialization
+
+class SerializerTestCase(LocalAuthTestCase):
+    def test_dumps_lists_and_tuples(self):
+        self.assertEqual(json.loads(dumps({'params': ['a', 'b'], 'row': (1, None)})),
+                         {'params': ['a', 'b'], 'row': [1, None]})
+
+    def test_json_response(self):
+        response = JSONResponse({'success': True}, 201)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(json.loads(response.get_data()), {'success': True})
+
+    def test_listing_records_from_rows(self):
+        self.add_bots(1000, 1)
+        res = self.client.get('/bots-detail', headers=self.headers)
+        self.assertEqual(res.mimetype, 'application/json')
+        bot = [bot for bot in json.loads(res.data) if bot['id'] == 1000][0]
+        self.assertEqual(bot, {
+            'id': 1000, 'name': 'Bot 1000', 'active': True, 'strategy': 'Query Count',
+            'strategy_id': 1000, 'timeframe': '1h', 'params': ['window'], 'param_values': ['7']
+        })
+
+
+# Response cache
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def test_entry_served_while_versions_match(self):
+        cache = ResponseCache()
+        cache.put('/bots', (1,), b'[]', 'application/json', 'bot.1')
+        self.assertEqual(cache.get('/bots', (1,))[1], b'[]')
+        self.assertIsNone(cache.get('/bots', (2,)))
+        self.assertEqual(cache.stats()['hit_ratio'], 0.5)
+
+    def test_cache_is_bounded_in_bytes(self):
+        cache = ResponseCache(max_bytes=10)
+        cache.put('/a', (1,), b'123456', 'application/json', None)
+        cache.put('/b', (1,), b'123456', 'application/json', None)
+        self.assertIsNone(cache.get('/a', (1,)))
+        self.assertIsNotNone(cache.get('/b', (1,)))
+        self.assertEqual(cache.evictions, 1)
+        self.assertLessEqual(cache.size, 10)
+
+
+# Query budgets
+
+class QueryBudgetTestCase(LocalAuthTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_bots(7000, 3)
+
+        @self.app.route('/n-plus-one')
+        @query_budget(2)
+        def n_plus_one():
+            for bot in Bot.query.filter(Bot.strategy_id == 1000).all():
+                Strategy.query.get(bot.strategy_id)
+                Bot.query.filter(Bot.id == bot.id).count()
+            return 'ok'
+
+    def test_fingerprint_ignores_literals(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM bot WHERE id = %(id_1)s AND name = 'x'"),
+            fingerprint("SELECT * FROM bot\n WHERE id = %(id_1)s AND name = 'y'"))
+        self.assertEqual(fingerprint('WHERE id IN (%(id_1)s, %(id_2)s)'), 'WHERE id IN (?)')
+
+    def test_over_budget_fails_in_testing(self):
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            self.client.get('/n-plus-one')
+        report = json.loads(str(raised.exception))
+        self.assertEqual(report['budget'], 2)
+        self.assertGreater(report['count'], 2)
+        self.assertEqual(report['repeats'], 3)
+
+    def test_over_budget_logs_in_production(self):
+        self.app.testing = False
+        with self.assertLogs('querycount', 'WARNING') as logs:
+            res = self.client.get('/n-plus-one')
+        self.assertEqual(res.status_code, 200)
+        report = json.loads(logs.records[0].getMessage())
+        self.assertEqual(report['endpoint'], '/n-plus-one')
+        self.assertIn('FROM bot', report['fingerprint'])
+
+    def test_listings_stay_within_budget(self):
+        for url in ('/strategies', '/strategies-detail', '/bots', '/bots-detail'):
+            res = self.client.get(url, headers=self.headers)
+            self.assertEqual(res.status_code, 200)
+
+
+# Prometheus metrics
+
+class MetricsTestCase(LocalAuthTestCase):
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_request_sql_and_jwt_are_recorded(self):
+        labels = {'endpoint': '/bots-detail', 'method': 'GET', 'status': '200'}
+        requests = self.sample('http_requests_total', **labels)
+        statements = self.sample('sql_statements_per_request_sum', endpoint='/bots-detail')
+        verified = self.sample('jwt_verify_seconds_count')
+
+        res = self.client.get('/bots-detail', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.sample('http_requests_total', **labels), requests + 1)
+        self.assertGreater(
+            self.sample('sql_statements_per_request_sum', endpoint='/bots-detail'), statements)
+        self.assertEqual(self.sample('jwt_verify_seconds_count'), verified + 1)
+
+    def test_metrics_endpoint(self):
+        self.client.get('/bots')
+        res = self.client.get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'http_request_duration_seconds_bucket{endpoint="/bots"', res.data)
+
+
+# Operational endpoints, get:stats only
+
+class StatsTestCase(LocalAuthTestCase):
+    def setUp(self):
+        super().setUp()
+        self.stats_headers = {
+            "Authorization": f"Bearer {self.local.token(['get:stats'])}"
+        }
+
+    def test_cache_stats_needs_permission(self):
+        self.assertEqual(self.client.get('/cache-stats').status_code, 401)
+        res = self.client.get('/cache-stats', headers=self.quant_headers)
+        self.assertEqual(res.status_code, 401)
+        res = self.client.get('/cache-stats', headers=self.stats_headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('hit_ratio', json.loads(res.data))
+
+    def test_pool_stats_needs_permission(self):
+        self.assertEqual(self.client.get('/pool-stats').status_code, 401)
+        res = self.client.get('/pool-stats', headers=self.quant_headers)
+        self.assertEqual(res.status_code, 401)
+        res = self.client.get('/pool-stats', headers=self.stats_headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('primary', json.loads(res.data))
+
+
+# Worker warm-up
+
+class WarmUpTestCase(LocalAuthTestCase):
+    def test_warm_up_primes_keys_and_database(self):
+        fetches = auth.jwks_store.fetch_count
+        timings = warm_up(self.app)
+        self.assertEqual(set(timings), {'jwks', 'pool', 'queries', 'listener'})
+        self.assertEqual(auth.jwks_store.fetch_count, fetches + 1)
+
+        res = self.client.get('/bots-detail', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(auth.jwks_store.fetch_count, fetches + 1)
+
+
+# Connection pool
+
+class PoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://', poolclass=TimedQueuePool,
+                                    pool_size=1, max_overflow=0, pool_timeout=0.05)
+
+    def test_status_tracks_checkouts_and_timeouts(self):
+        connection = self.engine.connect()
+        status = pool_status(self.engine)
+        self.assertEqual(status['checked_out'], 1)
+        self.assertEqual(status['checkouts'], 1)
+        self.assertEqual(status['connects'], 1)
+
+        with self.assertRaises(exc.TimeoutError):
+            self.engine.connect()
+        connection.close()
+        status = pool_status(self.engine)
+        self.assertEqual(status['checked_out'], 0)
+        self.assertEqual(status['timeouts'], 1)
+
+    def test_pools_keep_their_own_stats(self):
+        replica = create_engine('sqlite://', poolclass=TimedQueuePool, pool_size=1)
+        replica.pool.bind = 'replica'
+        self.engine.connect().close()
+        replica.connect().close()
+        replica.connect().close()
+        self.assertEqual(pool_status(self.engine)['checkouts'], 1)
+        self.assertEqual(pool_status(replica)['checkouts'], 2)
+        self.assertEqual(REGISTRY.get_sample_value(
+            'db_pool_checked_out', {'bind': 'replica'}), 0)
+
+    def test_pool_options_only_for_postgres(self):
+        self.assertEqual(engine_options('sqlite://'), {})
+        options = engine_options('postgresql://localhost/bots')
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertTrue(options['pool_pre_ping'])
+
+
+# JWKS key store, no Auth0 needed
+
+class JWKSStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.jwks = {
+            'keys': [{
+                'kty': 'RSA',
+                'kid': 'key-1',
+                'use': 'sig',
+                'n': 'modulus',
+                'e': 'AQAB'
+            }]
+        }
+        self.calls = 0
+
+    def fetcher(self):
+        self.calls += 1
+        return self.jwks
+
+    def test_keys_fetched_once(self):
+        store = JWKSStore(fetcher=self.fetcher, background=False)
+        for _ in range(10):
+            self.assertEqual(store.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(self.calls, 1)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        store = JWKSStore(fetcher=self.fetcher, background=False, min_refresh_interval=60)
+        store.get_key('key-1')
+        store._last_attempt -= 60
+        self.assertIsNone(store.get_key('key-2'))
+        self.assertIsNone(store.get_key('key-2'))
+        self.assertEqual(self.calls, 2)
+
+    def test_rotated_key_picked_up(self):
+        store = JWKSStore(fetcher=self.fetcher, background=False, min_refresh_interval=0)
+        store.get_key('key-1')
+        self.jwks['keys'][0]['kid'] = 'key-2'
+        self.assertEqual(store.get_key('key-2')['kid'], 'key-2')
+
+    def test_stale_keys_served_when_fetch_fails(self):
+        store = JWKSStore(fetcher=self.fetcher, background=False, min_refresh_interval=0)
+        store.get_key('key-1')
+
+        def broken():
+            raise OSError('Auth0 down')
+        store.fetcher = broken
+        store.refresh(force=True)
+        self.assertEqual(store.get_key('key-1')['kid'], 'key-1')
+
+    def test_keys_fetched_from_local_stand_in(self):
+        local = LocalAuth()
+        store = JWKSStore(fetcher=auth.url_jwks_fetcher(local.serve()), background=False)
+        self.assertEqual(store.get_key(local.kid)['kid'], local.kid)
+
+
+# Verified token cache, tokens signed with a local key
+
+class TokenCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.local = LocalAuth().install()
+
+    def test_repeat_token_is_cache_hit(self):
+        token = self.local.token(TRADER_PERMISSIONS)
+        payload, permissions = auth.verify_decode_jwt_cached(token)
+        self.assertEqual(auth.verify_decode_jwt_cached(token), (payload, permissions))
+        self.assertEqual(auth.token_cache.hits, 1)
+        self.assertEqual(auth.token_cache.misses, 1)
+        self.assertEqual(permissions, frozenset(TRADER_PERMISSIONS))
+
+    def test_entry_expires_at_exp(self):
+        cache = TokenCache()
+        cache.put('token', {'exp': 0, 'permissions': []})
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_cache_is_bounded(self):
+        cache = TokenCache(maxsize=2)
+        for token in ('a', 'b', 'c'):
+            cache.put(token, {'exp': 2 ** 40})
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(cache.evictions, 1)
+
+
 if __name__ == "__main__":
     unittest.main()
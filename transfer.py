@@ -0,0 +1,217 @@
+import os, tempfile, threading
+from queue import Queue, Empty, Full
+from flask import Response, stream_with_context
+
+from models import db, Strategy, Bot, sync_bot_params, commit_changes
+
+try:
+    import pyarrow
+    from pyarrow import csv as pyarrow_csv, parquet
+except ImportError:
+    pyarrow = None
+
+TRANSFER_TABLES = {'strategy': Strategy, 'bot': Bot}
+COPY_CHUNK_BYTES = 64 * 1024
+# Chunks buffered between the COPY and a slow client
+COPY_QUEUE_CHUNKS = int(os.environ.get('COPY_QUEUE_CHUNKS', 16))
+PARQUET_BATCH_ROWS = 64 * 1024
+
+
+'''
+Table transfer
+
+    Moves whole tables in and out with Postgres COPY, in CSV with a header
+    row and the columns in table order, arrays as Postgres literals ({a,b})
+    - created_at and updated_at are left out, imported rows are stamped
+      with the time of the import so delta syncs pick them up
+    - Nothing is held in memory but one chunk at a time, whatever the size
+      of the table
+    - Imports load the CSV into a temporary table and upsert it by id
+      (existing rows are overwritten), in one transaction, then rebuild the
+      typed bot parameters and bump the table version
+    - Parquet files are converted through CSV in batches, and need pyarrow
+'''
+
+# Stamped by the database on import, not transferred
+TIMESTAMP_COLUMNS = {'created_at', 'updated_at'}
+
+
+def copy_columns(model):
+    return [column.name for column in model.__table__.c if column.name not in TIMESTAMP_COLUMNS]
+
+
+def copy_out(connection, model, out):
+    table, columns = model.__tablename__, ', '.join(copy_columns(model))
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f'COPY (SELECT {columns} FROM {table} ORDER BY id) '
+            'TO STDOUT WITH (FORMAT csv, HEADER)', out)
+
+
+def copy_in(model, source):
+    table, names = model.__tablename__, copy_columns(model)
+    columns = ', '.join(names)
+    staging = f'import_{table}'
+    updates = ', '.join([f'{name} = EXCLUDED.{name}' for name in names if name != 'id'] +
+                        ['updated_at = now()'])
+
+    db.session.execute(db.text(
+        f'CREATE TEMP TABLE {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP'))
+    with db.session.connection().connection.cursor() as cursor:
+        cursor.copy_expert(
+            f'COPY {staging} ({columns}) FROM STDIN WITH (FORMAT csv, HEADER)',
+            source, size=COPY_CHUNK_BYTES)
+    count = db.session.execute(db.text(
+        f'INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} '
+        f'ON CONFLICT (id) DO UPDATE SET {updates}')).rowcount
+    # Imported ids must not be handed out again by the id sequence
+    db.session.execute(db.text(
+        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+        f'(SELECT max(id) FROM {table}))'))
+
+    if model is Bot:
+        sync_bot_params(where=f'bot.id IN (SELECT id FROM {staging})')
+    else:
+        sync_bot_params(where=f'bot.strategy_id IN (SELECT id FROM {staging})')
+    commit_changes(table, 'import')
+    return count
+
+
+'''
+ChunkPipe class
+
+    File-like object a COPY writes into from one thread while another one
+    iterates over it, in chunks of about COPY_CHUNK_BYTES
+    - At most COPY_QUEUE_CHUNKS chunks wait in between, the COPY blocks
+      until the reader catches up
+    - close() from the reader makes the next write fail, which aborts the
+      COPY when the client went away
+'''
+
+class ChunkPipe:
+    def __init__(self):
+        self.queue = Queue(COPY_QUEUE_CHUNKS)
+        self.closed = False
+        self._chunk, self._size = [], 0
+
+    def write(self, data):
+        self._chunk.append(data)
+        self._size += len(data)
+        if self._size >= COPY_CHUNK_BYTES:
+            self._put(b''.join(self._chunk))
+            self._chunk, self._size = [], 0
+
+    def finish(self, error=None):
+        if self._chunk and error is None:
+            self._put(b''.join(self._chunk))
+        self._put(error or StopIteration())
+
+    def _put(self, item):
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except Full:
+                pass
+        raise IOError('reader closed')
+
+    def close(self):
+        self.closed = True
+
+    def __iter__(self):
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=1)
+                except Empty:
+                    continue
+                if isinstance(item, StopIteration):
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+
+'''
+stream_copy(model) method
+
+    - Streams the whole table as CSV, the COPY runs on its own connection
+      in a background thread and is read chunk by chunk
+    - Returns a chunked text/csv Response
+'''
+
+def stream_copy(model):
+    engine = db.engine
+    pipe = ChunkPipe()
+
+    def run():
+        connection = engine.raw_connection()
+        error = None
+        try:
+            copy_out(connection, model, pipe)
+            connection.rollback()
+        except Exception as e:
+            error = e
+        finally:
+            connection.close()
+        try:
+            pipe.finish(error)
+        except IOError:
+            pass
+
+    threading.Thread(target=run, daemon=True).start()
+    response = Response(stream_with_context(iter(pipe)), mimetype='text/csv')
+    response.headers['Content-Disposition'] = \
+        f'attachment; filename={model.__tablename__}.csv'
+    return response
+
+
+'''
+Parquet files
+    export_parquet(model, path) and import_parquet(model, path) go through a
+    temporary CSV file, converted PARQUET_BATCH_ROWS rows at a time
+'''
+
+def parquet_schema(model):
+    types = {'INTEGER': pyarrow.int64(), 'BIGINT': pyarrow.int64(),
+             'BOOLEAN': pyarrow.bool_(), 'FLOAT': pyarrow.float64()}
+    return pyarrow.schema([
+        (column.name, types.get(str(column.type), pyarrow.string()))
+        for column in model.__table__.c if column.name not in TIMESTAMP_COLUMNS
+    ])
+
+
+def require_pyarrow():
+    if pyarrow is None:
+        raise RuntimeError('Parquet needs pyarrow (pip install pyarrow)')
+
+
+def export_parquet(connection, model, path):
+    require_pyarrow()
+    schema = parquet_schema(model)
+    with tempfile.NamedTemporaryFile(suffix='.csv') as tmp:
+        copy_out(connection, model, tmp)
+        tmp.flush()
+        reader = pyarrow_csv.open_csv(
+            tmp.name,
+            read_options=pyarrow_csv.ReadOptions(block_size=COPY_CHUNK_BYTES * 16),
+            convert_options=pyarrow_csv.ConvertOptions(
+                column_types=schema, include_columns=schema.names,
+                true_values=['t'], false_values=['f'],
+                strings_can_be_null=True, quoted_strings_can_be_null=False))
+        with parquet.ParquetWriter(path, schema) as writer:
+            for batch in reader:
+                writer.write_table(pyarrow.Table.from_batches([batch], schema))
+
+
+def import_parquet(model, path):
+    require_pyarrow()
+    source = parquet.ParquetFile(path)
+    with tempfile.TemporaryFile() as tmp:
+        with pyarrow_csv.CSVWriter(tmp, source.schema_arrow) as writer:
+            for batch in source.iter_batches(PARQUET_BATCH_ROWS):
+                writer.write_batch(batch)
+        tmp.seek(0)
+        return copy_in(model, tmp)
@@ -0,0 +1,65 @@
+import logging, os, time
+from sqlalchemy.orm import configure_mappers
+from sqlalchemy.pool import QueuePool
+
+import auth
+from changes import change_listener
+from fields import STRATEGY_FIELDS, STRATEGY_DETAIL_FIELDS, BOT_FIELDS, BOT_DETAIL_FIELDS
+from models import db, TableVersion
+from pool import DB_POOL_SIZE
+
+WARMUP_CONNECTIONS = int(os.environ.get('WARMUP_CONNECTIONS', DB_POOL_SIZE))
+
+logger = logging.getLogger(__name__)
+
+
+'''
+warm_up(app)
+
+    Does the first-request work of a worker before it accepts traffic and
+    returns the time each step took, in ms
+    - jwks: fetches the signing keys (a failure is logged, requests retry)
+    - pool: opens WARMUP_CONNECTIONS connections and returns them to the
+      pool, the first one also initializes the dialect
+    - queries: configures the mappers and runs the hot listing queries
+      once, so their compilation and loaders are ready
+    - listener: starts the change listener thread of the worker
+'''
+
+def hot_queries():
+    # The column queries of the listings without ?fields=
+    return [db.session.query(TableVersion.name, TableVersion.version)] + [
+        fieldset.query(list(fieldset.columns)).order_by(fieldset.entity.id)
+        for fieldset in (STRATEGY_FIELDS, STRATEGY_DETAIL_FIELDS, BOT_FIELDS, BOT_DETAIL_FIELDS)
+    ]
+
+
+def warm_up(app):
+    timings = {}
+
+    def step(name, f):
+        start = time.perf_counter()
+        try:
+            f()
+        except Exception:
+            logger.exception('warm-up step %s failed', name)
+        timings[name] = round((time.perf_counter() - start) * 1e3, 3)
+
+    def open_connections():
+        count = WARMUP_CONNECTIONS if isinstance(db.engine.pool, QueuePool) else 1
+        connections = [db.engine.connect() for _ in range(count)]
+        for connection in connections:
+            connection.close()
+
+    def run_queries():
+        configure_mappers()
+        for query in hot_queries():
+            query.limit(0).all()
+        db.session.remove()
+
+    step('jwks', lambda: auth.jwks_store.refresh(force=True))
+    with app.app_context():
+        step('pool', open_connections)
+        step('queries', run_queries)
+    step('listener', lambda: change_listener.start(app))
+    return timings